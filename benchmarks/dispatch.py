@@ -0,0 +1,56 @@
+"""
+Cost of dispatching one inbound message to its handler: parsing the request, building the `Query`
+and calling a handler that reads one argument.
+
+    python benchmarks/dispatch.py [messages]
+"""
+import asyncio
+import sys
+import time
+
+from wavegui import WaveApp
+from wavegui.main import ClientRequest, WaveClient
+
+
+class _WebSocket:
+    scope = {'session': {'session_id': 'BENCH'}}
+    url = 'ws://localhost/_s/'
+    headers = {}
+
+    async def send_text(self, text):
+        pass
+
+    async def close(self):
+        pass
+
+
+async def _handler(q):
+    if q.args.button:
+        pass
+
+
+async def main(n):
+    app = WaveApp()
+    app.setup('/bench', _handler)
+    client = WaveClient(_WebSocket())
+    msg = '@ /bench {"button":true,"textbox":"hello","slider":3,"":{"plot":{"select_marks":[{"x":1}]}}}'
+
+    start = time.perf_counter()
+    for _ in range(n):
+        ClientRequest.load(client, msg).json()
+    parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n):
+        req = ClientRequest.load(client, msg)
+        await client.process(req, client.websocket.url, client.websocket.headers)
+    total = time.perf_counter() - start
+
+    print(f'{n} messages')
+    print(f'parse:    {parse / n * 1e6:8.2f} us/message')
+    print(f'dispatch: {total / n * 1e6:8.2f} us/message')
+    await client.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+from wavegui.cache import ResultCache, cached
+from wavegui.session import Query, Session, UserInfo
+
+
+async def test_single_flight_and_stats():
+    cache = ResultCache(max_entries=2, ttl=60)
+    calls = []
+
+    async def compute(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    results = await asyncio.gather(*[cache.get_or_run(1, lambda: compute(1)) for _ in range(5)])
+    assert results == [2] * 5 and calls == [1]
+    assert await cache.get_or_run(1, lambda: compute(1)) == 2
+    assert cache.stats['misses'] == 1 and cache.stats['coalesced'] == 4 and cache.stats['hits'] == 1
+
+
+async def test_lru_and_ttl():
+    cache = ResultCache(max_entries=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.stats['evicted'] == 1
+    cache.put('d', 4, ttl=0)
+    assert cache.get('d') is None and cache.stats['expired'] == 1
+
+
+async def test_failures_are_not_cached():
+    cache = ResultCache()
+
+    async def fail():
+        raise ValueError('no')
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            await cache.get_or_run('k', fail)
+    assert cache.stats['misses'] == 2 and cache.stats['failed'] == 2 and len(cache) == 0
+
+
+async def test_cancelled_caller_does_not_cancel_others():
+    cache = ResultCache()
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    first = asyncio.create_task(cache.get_or_run('k', compute))
+    second = asyncio.create_task(cache.get_or_run('k', compute))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == 'done' and cache.get('k') == 'done'
+
+
+async def test_cached_decorator_and_cached_run():
+    cache = ResultCache.default = ResultCache()
+    calls = []
+
+    @cached(ttl=10)
+    async def load(x):
+        calls.append(x)
+        return x + 1
+
+    assert await load(1) == await load(1) == 2 and calls == [1]
+
+    def report(day):
+        calls.append(day)
+        return f'report {day}'
+
+    q = Query(UserInfo(), Session('CACHE'), '/', '', {}, None, None, None)
+    assert await q.cached_run(('report', 3), report, 3) == await q.cached_run(('report', 3), report, 3) == 'report 3'
+    assert calls == [1, 3] and cache.stats['hits'] == 2
+    ResultCache.default = None
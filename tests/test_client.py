@@ -0,0 +1,240 @@
+import asyncio
+import time
+import pytest
+from wavegui import codec
+from wavegui.exception import DeadlineExceededError, TaskRejectedError
+from wavegui.main import WaveApp, WaveClient, WaveServer
+from wavegui.session import Query, Session, SessionRegistry, UserInfo
+from wavegui.task import TaskManager, TimerWheel, remaining, set_deadline, reset_deadline
+
+
+class FakeWebSocket:
+    def __init__(self, session_id='WSTEST', user_id=None):
+        self.scope = {'session': {'session_id': session_id, 'user_id': user_id}}
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    registry = SessionRegistry()
+    monkeypatch.setattr(Session, 'registry', registry)
+    return registry
+
+
+async def _sync(client, route, saves):
+    client.page_route = route
+    page = client.session.page(route)
+    task = asyncio.create_task(client.page_sync())
+    await asyncio.sleep(0)
+    for i in range(saves):
+        page['card'] = {'view': 'markdown', 'title': str(i)}
+        await page.save()
+    await asyncio.sleep(0.05)
+    task.cancel()
+    return [[codec.loads(line) for line in text.split('\n')] for text in client.websocket.sent]
+
+
+async def test_frame_per_patch():
+    client = WaveClient(FakeWebSocket())
+    frames = await _sync(client, '/test', 3)
+    assert len(frames) == 4
+    assert frames[0] == [{'p': {'c': {}}, 's': 0, 'e': client.session.page('/test').epoch}]
+
+
+async def test_flush_window_batches_patches():
+    client = WaveClient(FakeWebSocket(), flush_window=20)
+    frames = await _sync(client, '/test', 3)
+    assert len(frames) == 2
+    assert [m['d'][0]['d']['title'] for m in frames[1]] == ['0', '1', '2']
+
+
+async def test_max_batch():
+    client = WaveClient(FakeWebSocket(), flush_window=20, max_batch=2)
+    frames = await _sync(client, '/test', 3)
+    assert [len(f) for f in frames] == [1, 2, 1]
+
+
+async def test_resume_sends_missed_patches(monkeypatch):
+    monkeypatch.setitem(Session._page_options, 'ring_size', 8)
+    client = WaveClient(FakeWebSocket())
+    page = client.session.page('/test')
+    for title in ['a', 'b', 'c']:
+        page['card'] = {'view': 'markdown', 'title': title}
+        await page.save()
+    client.resume = (1, page.epoch)
+    frames = await _sync(client, '/test', 0)
+    assert [m['s'] for m in frames[0]] == [2, 3]
+
+
+async def test_resume_from_other_page_history_gets_snapshot(registry):
+    client = WaveClient(FakeWebSocket())
+    page = client.session.page('/test')
+    for title in ['a', 'b', 'c']:
+        page['card'] = {'view': 'markdown', 'title': title}
+        await page.save()
+    epoch = page.epoch
+    # the session is evicted, its page starts again from 0.
+    registry.evict(client.session.session_id)
+    client.session = registry.get(client.session.session_id)
+    page = client.session.page('/test')
+    page['card'] = {'view': 'markdown', 'title': 'new'}
+    await page.save()
+    client.resume = (1, epoch)
+    frames = await _sync(client, '/test', 0)
+    assert frames[0][0]['e'] == page.epoch != epoch
+    assert frames[0][0]['p']['c']['card']['d']['title'] == 'new'
+
+
+async def test_reconnect_reuses_session(registry):
+    client = WaveClient(FakeWebSocket())
+    assert client.session.clients == 1
+    await client.close()
+    await client.close()
+    assert client.session.clients == 0
+    again = WaveClient(FakeWebSocket())
+    assert again.session is client.session
+    assert len(registry) == 1
+    await again.close()
+
+
+async def test_broadcast_page_shared_by_clients():
+    async def wall(q):
+        pass
+    WaveApp().setup('/wall', wall, 'broadcast')
+    clients = [WaveClient(FakeWebSocket(f'WALL{i}')) for i in range(2)]
+    frames = await asyncio.gather(*[_sync(client, '/wall', 0) for client in clients], _save_shared('/wall'))
+    assert frames[0] == frames[1]
+    assert clients[0].websocket.sent[-1] is clients[1].websocket.sent[-1]
+
+
+async def _save_shared(route, watchers=2):
+    page = Session.registry.shared.page(('broadcast', route), route)
+    while len(page.subscriptions) < watchers:
+        await asyncio.sleep(0.001)
+    page['card'] = {'view': 'markdown', 'title': 'x'}
+    await page.save()
+
+
+async def test_multicast_page_per_user():
+    async def feed(q):
+        pass
+    WaveApp().setup('/feed', feed, 'multicast')
+    alice, bob = WaveClient(FakeWebSocket('ALICE')), WaveClient(FakeWebSocket('BOB'))
+    pages = [_client_page(client, '/feed') for client in (alice, bob)]
+    # without a signed-in user every session has its own page.
+    assert pages[0] is not pages[1]
+    assert pages[0] is _client_page(WaveClient(FakeWebSocket('ALICE')), '/feed')
+    # the user signed into the session cookie.
+    alice, bob = WaveClient(FakeWebSocket('ALICE', 'u1')), WaveClient(FakeWebSocket('BOB', 'u1'))
+    assert alice.user_info.user_id == 'u1'
+    assert _client_page(alice, '/feed') is _client_page(bob, '/feed')
+    assert _client_page(alice, '/feed').backpressure == 'conflate'
+    bob.user_info = UserInfo('u2')
+    assert _client_page(alice, '/feed') is not _client_page(bob, '/feed')
+
+
+@pytest.mark.filterwarnings('ignore::DeprecationWarning')
+def test_shared_pages_refuse_workers(tmp_path):
+    async def wall(q):
+        pass
+    WaveApp().setup('/wall-workers', wall, 'broadcast')
+    with pytest.raises(ValueError, match='/wall-workers'):
+        WaveServer(upload_dir=str(tmp_path)).run_forever(workers=2)
+
+
+def _client_page(client, route):
+    q = Query(client.user_info, client.session, route, '', {}, None, None, client.task_manager, WaveApp.mode_of(route))
+    return q.page
+
+
+async def test_disconnected_client_rejects_tasks():
+    client = WaveClient(FakeWebSocket('GONE'))
+    q = Query(client.user_info, client.session, '/', '', {}, None, None, client.task_manager)
+    await client.close()
+    # a handler still running after the disconnect.
+    with pytest.raises(TaskRejectedError):
+        await q.run_in_back(asyncio.sleep(1))
+    assert client.session.usage.tasks == 0
+
+
+def test_query_is_lazy():
+    session = Session('LAZY')
+    q = Query(UserInfo(), session, '/lazy', '', {}, {'x': 1}, None, None)
+    assert session.pages == {}
+    assert q.args.x == 1 and q.events.anything is None
+    assert q.page is session.page('/lazy')
+    with pytest.raises(AttributeError):
+        q.other = 1
+
+
+async def test_exec_within_deadline():
+    q = Query(UserInfo(), Session('DEADLINE'), '/', '', {}, None, None, TaskManager('DEADLINE', scheduler=None))
+    handle = await q.run_in_back(q.exec(None, time.sleep, 0.2), timeout=0.05)
+    with pytest.raises(DeadlineExceededError):
+        await handle
+    assert handle.reason == 'deadline'
+    token = set_deadline(1)
+    try:
+        assert await q.run(lambda: remaining()) <= 1
+    finally:
+        reset_deadline(token)
+
+
+async def test_every_runs_while_watched():
+    TimerWheel.default = TimerWheel(tick=0.01)
+    first = WaveClient(FakeWebSocket('EVERY'))
+    session = first.session
+    q = Query(first.user_info, session, '/every', '', {}, None, None, first.task_manager)
+    managers = []
+
+    async def tick(q):
+        managers.append(q.task_manager)
+
+    timer = q.every(0.01, tick)
+    await asyncio.sleep(0.05)
+    assert managers == [] and timer.skipped > 0
+    # runs go to the client connected now, through its task pool.
+    await first.close()
+    second = WaveClient(FakeWebSocket('EVERY'))
+    sub = session.page('/every').subscribe()
+    await asyncio.sleep(0.05)
+    assert managers and set(managers) == {second.task_manager}
+    assert second.task_manager.pool.stats['spawned'] >= len(managers)
+    session.page('/every').unsubscribe(sub)
+    session.close()
+    assert timer.cancelled and session.timers == set()
+    await second.close()
+    TimerWheel.default.stop()
+    await asyncio.sleep(0)
+    TimerWheel.default = None
+
+
+async def test_handler_error_on_shared_page_goes_to_its_client():
+    async def broken(q):
+        raise ValueError('broken')
+    WaveApp().setup('/broken', broken, 'broadcast')
+    page = Session.registry.shared.page(('broadcast', '/broken'), '/broken')
+    page['card'] = {'view': 'markdown', 'title': 'x'}
+    await page.save()
+    client = WaveClient(FakeWebSocket('BROKEN'))
+    await client.process(_Request('/broken'), '', {})
+    assert page.seq == 1 and 'card' in page.data
+    error = codec.loads(client.websocket.sent[-1])
+    assert error['d'][0]['k'] == '__unhandled_error__' and 's' not in error
+
+
+class _Request:
+    def __init__(self, addr):
+        self.addr = addr
+
+    def json(self):
+        return {}
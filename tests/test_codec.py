@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+from datetime import date, datetime
+from enum import Enum
+from uuid import UUID
+import pytest
+from wavegui import codec
+from wavegui.core import marshal, unmarshal
+
+
+@pytest.fixture(params=['json', 'orjson', 'msgspec'])
+def backend(request):
+    if request.param not in codec._backends:
+        pytest.skip(f'{request.param} not installed')
+    codec.use(request.param)
+    yield request.param
+    codec.use()
+
+
+def test_same_output(backend):
+    d = {'d': [{'k': 'card', 'd': {'title': 'äöü', 'items': (1, 2.5, None, True)}}], 1: 'x'}
+    assert codec.dumps(d) == '{"d":[{"k":"card","d":{"title":"äöü","items":[1,2.5,null,true]}}],"1":"x"}'
+    assert codec.dumpb(d) == codec.dumps(d).encode('utf-8')
+    assert codec.dumps(2 ** 70) == str(2 ** 70)
+    assert codec.dumps([1e20, 1e-7, 1.5e-5, -1e-5, 1e16, 0.0001, 1.2e-300]) == \
+        '[1e20,1e-7,0.000015,-0.00001,1e16,0.0001,1.2e-300]'
+    assert codec.dumps({'1e+20': '1e-07'}) == '{"1e+20":"1e-07"}'
+    assert codec.dumps([UUID(int=1), Color.RED]) == '["00000000-0000-0000-0000-000000000001","red"]'
+
+
+def test_non_finite_floats_are_null(backend):
+    nan, inf = float('nan'), float('inf')
+    assert codec.dumps({'v': [nan, inf, -inf, 1.0], 'NaN': 'Infinity'}) == '{"v":[null,null,null,1.0],"NaN":"Infinity"}'
+
+
+class Color(Enum):
+    RED = 'red'
+
+
+@dataclass
+class Point:
+    x: int
+
+
+def test_same_types_rejected(backend):
+    if backend == 'msgspec':
+        pytest.skip('msgspec encodes these natively')
+    for value in (date(2020, 1, 1), datetime(2020, 1, 1), Point(1), b'x', {1, 2}):
+        with pytest.raises(TypeError):
+            codec.dumps({'t': value})
+
+
+def test_loads(backend):
+    assert codec.loads('{"a":[1,"b"]}') == {'a': [1, 'b']}
+    assert codec.loads(b'{"a":1}') == {'a': 1}
+    with pytest.raises(ValueError):
+        codec.loads('{')
+
+
+def test_marshal(backend):
+    assert unmarshal(marshal({'a': 'b'})) == {'a': 'b'}
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        codec.use('nope')
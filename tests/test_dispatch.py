@@ -0,0 +1,53 @@
+import asyncio
+from base64 import b64encode
+import json
+from itsdangerous import TimestampSigner
+from wavegui.dispatch import Dispatcher, session_id_from_cookie, worker_index
+
+
+def _cookie(session_id, secret='secret'):
+    data = b64encode(json.dumps({'session_id': session_id}).encode('utf-8'))
+    return 'wave-session=' + TimestampSigner(secret).sign(data).decode('utf-8')
+
+
+def test_session_id_from_cookie():
+    assert session_id_from_cookie('a=b; ' + _cookie('S1'), 'wave-session', 'secret') == 'S1'
+    assert session_id_from_cookie(_cookie('S1', 'other'), 'wave-session', 'secret') is None
+    assert session_id_from_cookie('', 'wave-session', 'secret') is None
+
+
+def test_worker_index_is_stable():
+    assert worker_index('S1', 4) == worker_index('S1', 4)
+    assert {worker_index(f'S{i}', 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+async def _worker(path, name):
+    async def handle(reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        writer.write(name.encode() + b' ' + head.split(b' ')[1])
+        await writer.drain()
+        writer.close()
+    return await asyncio.start_unix_server(handle, path)
+
+
+async def test_dispatch_by_session(tmp_path):
+    sockets = [str(tmp_path / f'w{i}.sock') for i in range(3)]
+    workers = [await _worker(path, f'w{i}') for i, path in enumerate(sockets)]
+    dispatcher = Dispatcher(sockets, secret_key='secret')
+    server = await asyncio.start_server(dispatcher.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def request(path, cookie):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: x\r\nCookie: {cookie}\r\n\r\n'.encode())
+        await writer.drain()
+        data = await reader.read()
+        writer.close()
+        return data.decode()
+
+    expected = f'w{worker_index("S1", 3)} /_s/'
+    assert [await request('/_s/', _cookie('S1')) for _ in range(3)] == [expected] * 3
+    assert dispatcher.stats['affine'] == 3
+    server.close()
+    for worker in workers:
+        worker.close()
@@ -0,0 +1,79 @@
+import asyncio
+from wavegui.inbound import InboundPipeline
+from wavegui.main import ClientRequest
+
+
+def _query(route, data):
+    return ClientRequest(None, 'query', route, data)
+
+
+class Recorder:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.handled = []
+
+    async def __call__(self, req):
+        await asyncio.sleep(self.delay)
+        self.handled.append((req.addr, req.data))
+
+
+async def test_requests_handled_in_order():
+    handler = Recorder(0.01)
+    pipeline = InboundPipeline(handler)
+    for i in range(3):
+        pipeline.submit(_query('/a', f'{{"x": {i}}}'))
+    await pipeline.join()
+    assert handler.handled == [('/a', '{"x": 0}'), ('/a', '{"x": 1}'), ('/a', '{"x": 2}')]
+
+
+async def test_coalesce_waiting_requests():
+    handler = Recorder(0.01)
+    pipeline = InboundPipeline(handler, coalesce=True)
+    for i in range(4):
+        pipeline.submit(_query('/a', f'{{"slider": {i}}}'))
+    pipeline.submit(_query('/a', '{"button": true}'))
+    pipeline.submit(_query('/a', '{"slider": 9}'))
+    await pipeline.join()
+    assert handler.handled == [('/a', '{"slider": 3}'), ('/a', '{"button": true}'), ('/a', '{"slider": 9}')]
+    assert pipeline.stats['coalesced'] == 3
+
+
+async def test_coalesce_keeps_the_order_of_requests():
+    handler = Recorder(0.01)
+    pipeline = InboundPipeline(handler, coalesce=True)
+    pipeline.submit(_query('/a', '{"busy": true}'))
+    pipeline.submit(_query('/a', '{"slider": 1}'))
+    pipeline.submit(_query('/a', '{"save": true}'))
+    pipeline.submit(_query('/a', '{"slider": 2}'))
+    await pipeline.join()
+    # save sees the slider the user set before clicking it.
+    assert handler.handled == [('/a', '{"busy": true}'), ('/a', '{"slider": 1}'), ('/a', '{"save": true}'),
+                               ('/a', '{"slider": 2}')]
+    assert pipeline.stats['coalesced'] == 0
+
+
+async def test_debounce():
+    handler = Recorder()
+    pipeline = InboundPipeline(handler, debounce=20)
+    for i in range(4):
+        pipeline.submit(_query('/a', f'{{"slider": {i}}}'))
+        await asyncio.sleep(0.005)
+    await pipeline.join()
+    assert handler.handled == [('/a', '{"slider": 3}')]
+
+
+async def test_concurrent_routes():
+    handler = Recorder(0.02)
+    pipeline = InboundPipeline(handler, concurrent_routes=True)
+    pipeline.submit(_query('/a', '{"x": 1}'))
+    pipeline.submit(_query('/b', '{"x": 1}'))
+    await asyncio.sleep(0.03)
+    assert len(handler.handled) == 2
+    await pipeline.join()
+
+
+def test_coalesce_key():
+    assert _query('/a', '{"b": 1, "a": 2}').coalesce_key() == ('/a', ('a', 'b'), ())
+    assert _query('/a', '{"": {"plot": {"select_marks": 1}}}').coalesce_key() == ('/a', (), (('plot', 'select_marks'),))
+    assert _query('/a', 'hash').coalesce_key() is None
+    assert ClientRequest(None, 'watch', '/a', '').coalesce_key() is None
@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from wavegui import quota
+from wavegui.exception import QuotaExceededError, SlowConsumerError, TaskRejectedError
+from wavegui.quota import Quota
+from wavegui.session import Query, Session, UserInfo
+from wavegui.task import TaskManager
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def configure(**kwargs):
+        monkeypatch.setattr(Session, 'quota', Quota(**kwargs))
+        return Session('QUOTA')
+    return configure
+
+
+async def _save(page, title):
+    page['card'] = {'view': 'markdown', 'title': title}
+    await page.save()
+
+
+async def test_page_bytes_rejects_saves(session):
+    s = session(page_bytes=(50, 200))
+    page = s.page('/')
+    await _save(page, 'x' * 100)
+    await _save(page, 'x' * 300)
+    assert s.usage.soft['page_bytes'] == 1
+    with pytest.raises(QuotaExceededError):
+        await _save(page, 'y')
+    assert s.usage.hard['page_bytes'] == 1
+    page.drop()
+    await page.save()
+    await _save(page, 'z')
+    assert page.data == {'card': {'d': {'view': 'markdown', 'title': 'z'}}}
+
+
+async def test_queued_bytes_sheds(session):
+    s = session(queued_bytes=150)
+    page = s.page('/')
+    sub = page.subscribe(s.usage)
+    for title in 'abc':
+        await _save(page, title)
+    assert s.usage.hard['queued_bytes'] == 1
+    assert sub.pending() == 1 and s.usage.queued_bytes == sub.queued_bytes
+    snapshot = await sub.changes()
+    sub.send_done()
+    assert b'"p"' in snapshot.payload
+    assert s.usage.queued_bytes == 0
+
+
+async def test_queued_bytes_disconnect(session):
+    s = session(queued_bytes=150, on_queue_full='disconnect')
+    page = s.page('/')
+    sub = page.subscribe(s.usage)
+    for title in 'abc':
+        await _save(page, title)
+    with pytest.raises(SlowConsumerError):
+        await sub.changes()
+    assert s.usage.queued_bytes == 0
+
+
+async def test_tasks_counted_from_admission(session):
+    s = session(tasks=2)
+    q = Query(UserInfo(), s, '/', '', {}, None, None, TaskManager('QUOTA', pool_size=1, scheduler=None))
+    handles = []
+    for _ in range(10):
+        try:
+            handles.append(await q.run_in_back(asyncio.sleep(0.01)))
+        except QuotaExceededError:
+            pass
+    assert len(handles) == 2 and s.usage.tasks == 2 and s.usage.hard['tasks'] == 8
+    handles[1].cancel()
+    await handles[0]
+    assert s.usage.tasks == 0
+    with pytest.raises(Exception, match='Only coroutine'):
+        await q.run_in_back(lambda: None)
+    assert s.usage.tasks == 0
+
+
+async def test_rejected_task_is_closed(session):
+    s = session()
+    q = Query(UserInfo(), s, '/', '', {}, None, None, TaskManager('FULL', pool_size=1, max_pending=0, scheduler=None))
+    running = await q.run_in_back(asyncio.sleep(0.01))
+    with pytest.raises(TaskRejectedError):
+        await q.run_in_back(asyncio.sleep(0.01))
+    assert s.usage.tasks == 1
+    await running
+
+
+def test_message_rate(session, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(quota, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    usage = session(message_rate=(2, 3)).usage
+    assert [usage.message() for _ in range(4)] == [None, None, None, 'reject']
+    assert usage.soft['message_rate'] == 1 and usage.hard['message_rate'] == 1
+    now[0] += 1
+    assert usage.message() is None and usage.message_rate() == 1
+    assert usage.report()['messages'] == 5
@@ -0,0 +1,355 @@
+import asyncio
+import pytest
+from wavegui import codec, ui
+from wavegui.exception import SlowConsumerError
+from wavegui.session import AsyncPage, Patch, SessionRegistry, coalesce_patches
+
+
+def test_coalesce_card_replaced():
+    patches = [
+        Patch([{'k': 'counter', 'd': {'title': '1'}}]),
+        Patch([{'k': 'counter', 'd': {'title': '2'}}]),
+        Patch([{'k': 'other', 'd': {'title': 'x'}}]),
+        Patch([{'k': 'counter', 'd': {'title': '3'}}]),
+    ]
+    assert coalesce_patches(patches).ops == [
+        {'k': 'other', 'd': {'title': 'x'}},
+        {'k': 'counter', 'd': {'title': '3'}},
+    ]
+
+
+def test_coalesce_ref_paths():
+    patches = [
+        Patch([{'k': 'form items 0 value', 'v': 1}, {'k': 'form title', 'v': 'a'}]),
+        Patch([{'k': 'form items', 'v': []}, {'k': 'form title', 'v': 'b'}]),
+    ]
+    assert coalesce_patches(patches).ops == [
+        {'k': 'form items', 'v': []},
+        {'k': 'form title', 'v': 'b'},
+    ]
+
+
+def test_coalesce_keeps_parent_before_child():
+    patches = [
+        Patch([{'k': 'card', 'd': {'title': 'a'}}]),
+        Patch([{'k': 'card title', 'v': 'b'}]),
+    ]
+    assert coalesce_patches(patches).ops == [
+        {'k': 'card', 'd': {'title': 'a'}},
+        {'k': 'card title', 'v': 'b'},
+    ]
+
+
+def test_coalesce_appends_and_drop():
+    patches = [
+        Patch([{'k': 'old', 'd': {}}]),
+        Patch([{}]),
+        Patch([{'k': 'plot data __append__', 'v': [1]}]),
+        Patch([{'k': 'plot data __append__', 'v': [2]}]),
+    ]
+    assert coalesce_patches(patches).ops == [
+        {},
+        {'k': 'plot data __append__', 'v': [1]},
+        {'k': 'plot data __append__', 'v': [2]},
+    ]
+
+
+async def test_page_changes_coalesced():
+    page = AsyncPage('/test', coalesce=True)
+    sub = page.subscribe()
+    for i in range(3):
+        page['counter'] = {'view': 'markdown', 'title': str(i)}
+        await page.save()
+    data = await sub.changes()
+    sub.send_done()
+    assert data.ops == [{'k': 'counter', 'd': {'view': 'markdown', 'title': '2'}}]
+    assert sub._queue.empty()
+
+
+async def test_patch_encoded_once():
+    page = AsyncPage('/test')
+    sub = page.subscribe()
+    page['card'] = {'view': 'markdown', 'title': 'ä'}
+    await page.save()
+    patch = await sub.changes()
+    sub.send_done()
+    assert codec.loads(patch.payload) == {'d': [{'k': 'card', 'd': {'view': 'markdown', 'title': 'ä'}}], 's': 1}
+    assert patch.text is patch.text
+    snapshot, = await sub.start_sync()
+    assert [snapshot] == await sub.start_sync()
+    assert codec.loads(snapshot.text) == {'p': {'c': {'card': {'d': {'view': 'markdown', 'title': 'ä'}}}}, 's': 1,
+                                          'e': page.epoch}
+
+
+async def _save_titles(page, titles):
+    for title in titles:
+        page['card'] = {'view': 'markdown', 'title': title}
+        await page.save()
+
+
+async def test_backpressure_drop_oldest():
+    page = AsyncPage('/test', queue_size=2, backpressure='drop_oldest')
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b', 'c'])
+    assert page.backpressure_stats['dropped'] == 1
+    frame = await sub.changes()
+    sub.send_done()
+    assert codec.loads(frame.payload) == {'p': {'c': {'card': {'d': {'view': 'markdown', 'title': 'c'}}}}, 's': 3,
+                                          'e': page.epoch}
+    assert sub._queue.empty()
+
+
+async def test_backpressure_conflate():
+    page = AsyncPage('/test', queue_size=2, backpressure='conflate')
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b', 'c', 'd'])
+    assert page.backpressure_stats['conflated'] == 1
+    patch = await sub.changes()
+    sub.send_done()
+    assert patch.ops == [{'k': 'card', 'd': {'view': 'markdown', 'title': 'c'}}]
+    patch = await sub.changes()
+    sub.send_done()
+    assert patch.ops == [{'k': 'card', 'd': {'view': 'markdown', 'title': 'd'}}]
+
+
+async def test_backpressure_block_timeout():
+    page = AsyncPage('/test', queue_size=1, block_timeout=0.01)
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b'])
+    assert page.backpressure_stats['blocked'] == 1
+    assert page.backpressure_stats['timeout'] == 1
+
+
+async def test_backpressure_block_does_not_delay_other_clients():
+    page = AsyncPage('/test', queue_size=1, block_timeout=1)
+    slow, fast = page.subscribe(), page.subscribe()
+    await _save_titles(page, ['a'])
+    await fast.changes()
+    fast.send_done()
+    save = asyncio.ensure_future(_save_titles(page, ['b']))
+    await asyncio.sleep(0.01)
+    assert not save.done() and fast.pending() == 1
+    await slow.changes()
+    slow.send_done()
+    await save
+    assert page.backpressure_stats['blocked'] == 1 and page.backpressure_stats['timeout'] == 0
+
+
+async def test_backpressure_disconnect():
+    page = AsyncPage('/test', queue_size=1, backpressure='disconnect')
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b'])
+    assert page.backpressure_stats['disconnected'] == 1
+    with pytest.raises(SlowConsumerError):
+        await sub.changes()
+
+
+def test_backpressure_unknown_policy():
+    with pytest.raises(ValueError):
+        AsyncPage('/test', backpressure='nope')
+
+
+async def test_resume_from_ring():
+    page = AsyncPage('/test', ring_size=2)
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b', 'c'])
+    assert page.seq == 3
+    assert await sub.start_sync(resume=(3, page.epoch)) == []
+    patches = await sub.start_sync(resume=(1, page.epoch))
+    assert [p.seq for p in patches] == [2, 3]
+    snapshot, = await sub.start_sync(resume=(0, page.epoch))
+    assert codec.loads(snapshot.payload)['s'] == 3
+    snapshot, = await sub.start_sync(resume=(7, page.epoch))
+    assert 'p' in codec.loads(snapshot.payload)
+    # another history of the page, or a client that does not know the epoch.
+    for epoch in ('other', None):
+        snapshot, = await sub.start_sync(resume=(3, epoch))
+        assert 'p' in codec.loads(snapshot.payload)
+
+
+async def test_ring_is_off_by_default_and_dropped_by_compaction():
+    page = AsyncPage('/test')
+    await _save_titles(page, ['a', 'b'])
+    assert len(page._ring) == 0
+    page = AsyncPage('/test', ring_size=8, compact='raw')
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b'])
+    assert len(page._ring) == 2
+    page.unsubscribe(sub)
+    await _save_titles(page, ['c'])
+    assert len(page._ring) == 0 and page.memory_size() == page._state.packed_size()
+
+
+async def test_changes_skip_patches_in_snapshot():
+    page = AsyncPage('/test')
+    sub = page.subscribe()
+    await _save_titles(page, ['a', 'b'])
+    await sub.start_sync()
+    await page.save()
+    await _save_titles(page, ['c'])
+    empty = await sub.changes()
+    sub.send_done()
+    assert empty.ops == [] and empty.seq == 2
+    patch = await sub.changes()
+    sub.send_done()
+    assert patch.seq == 3
+
+
+async def test_unwatched_page_queues_nothing():
+    page = AsyncPage('/test', queue_size=1)
+    await _save_titles(page, ['a', 'b', 'c'])
+    assert page.backpressure_stats['blocked'] == 0
+    sub = page.subscribe()
+    snapshot, = await sub.start_sync()
+    assert codec.loads(snapshot.payload)['s'] == 3
+    page.unsubscribe(sub)
+    assert not page.watched
+
+
+async def test_patch_fans_out_to_every_watcher():
+    page = AsyncPage('/test')
+    subs = [page.subscribe(), page.subscribe()]
+    await _save_titles(page, ['a'])
+    patches = [await sub.changes() for sub in subs]
+    assert patches[0] is patches[1]
+
+
+async def test_idle_page_compacted():
+    page = AsyncPage('/test', compact='zlib')
+    sub = page.subscribe()
+    await _save_titles(page, ['a'])
+    page.unsubscribe(sub)
+    assert page._state.cards == {} and 'card' in page._state.packed
+    page['other'] = {'view': 'markdown', 'title': 'b'}
+    await page.save()
+    assert page._state.cards == {} and page._snapshot is None
+    snapshot, = await page.subscribe().start_sync()
+    assert codec.loads(snapshot.payload)['p']['c'] == {
+        'card': {'d': {'view': 'markdown', 'title': 'a'}},
+        'other': {'d': {'view': 'markdown', 'title': 'b'}},
+    }
+    assert page._state.packed == {}
+
+
+async def test_compacted_page_woken_by_a_read_stays_compacted(tmp_path):
+    page = AsyncPage('/test', compact='raw', diff=True)
+    sub = page.subscribe()
+    page['card'] = {'view': 'markdown', 'title': 'x' * 40}
+    await page.save()
+    assert page._cards
+    page.unsubscribe(sub)
+    assert page._cards == {}
+    size = page.memory_size()
+    assert size == page._state.packed_size() > 0
+    page.hibernate(str(tmp_path / 'page'))
+    assert page.data['card']['d']['title'] == 'x' * 40
+    assert not page.hibernated and page._state.cards == {} and page.memory_size() == size
+
+
+def _form(*values):
+    return ui.form_card(box='1 1 4 10', items=[ui.checkbox(name=f'c{i}', label='x' * 50, value=v) for i, v in enumerate(values)])
+
+
+async def test_diff_cards():
+    page = AsyncPage('/test', diff=True)
+    page['form'] = _form(False, False, False)
+    assert 'd' in page._get_diff()[0]
+    page['form'] = _form(False, True, False)
+    assert page._get_diff() == [{'k': 'form items 1 checkbox value', 'v': True}]
+    page['form'] = _form(False, True, False)
+    assert page._get_diff() is None
+    page['form'] = _form(False, True, False, True)
+    assert [op['k'] for op in page._get_diff()] == ['form items']
+    page['form'] = ui.markdown_card(box='1 1 4 10', title='', content='')
+    assert 'd' in page._get_diff()[0]
+
+
+async def test_diff_cards_after_ref_update():
+    page = AsyncPage('/test', diff=True)
+    page['form'] = _form(False)
+    page['form'].c0.value = True
+    page['form'] = _form(False)
+    ops = page._get_diff()
+    assert 'd' in ops[-1]
+    await page._patch(ops)
+    assert page.data['form']['d']['items'][0]['checkbox'].get('value') is False
+
+
+async def test_registry_lru_and_ttl():
+    registry = SessionRegistry(ttl=None, max_sessions=2)
+    evicted = []
+    registry.on_evict(lambda session, reason: evicted.append((session.session_id, reason)))
+    a = registry.get('a')
+    a.attach()
+    registry.get('b')
+    registry.get('c')
+    assert evicted == [('b', 'lru')]
+    assert 'a' in registry and 'c' in registry
+    registry.ttl = 0
+    registry.prune()
+    assert evicted == [('b', 'lru'), ('c', 'ttl')]
+    a.detach()
+    registry.prune()
+    assert len(registry) == 0
+
+
+async def test_registry_get_never_evicts_the_session_returned():
+    registry = SessionRegistry(ttl=None, max_sessions=1)
+    evicted = []
+    registry.on_evict(lambda session, reason: evicted.append(session.session_id))
+    registry.get('a').attach()
+    b = registry.get('b')
+    assert evicted == [] and registry.get('b') is b
+    b.attach()
+    registry.get('c')
+    assert evicted == [] and 'b' in registry
+
+
+async def test_registry_byte_budget():
+    registry = SessionRegistry(ttl=None, max_bytes=200)
+    for sid in ('a', 'b'):
+        page = registry.get(sid).page('/test')
+        await _save_titles(page, ['x' * 40])
+    registry.prune()
+    assert 'a' not in registry and 'b' in registry
+    assert registry.stats['bytes'] == 1
+
+
+async def test_registry_budget_does_not_keep_snapshots():
+    registry = SessionRegistry(ttl=None, max_bytes=10 ** 6)
+    page = registry.get('a').page('/test')
+    sub = page.subscribe()
+    await _save_titles(page, ['x' * 40])
+    registry.prune()
+    assert page._snapshot is None and page.snapshot_size() == len(page.snapshot())
+    page.unsubscribe(sub)
+
+
+async def test_registry_prunes_periodically():
+    registry = SessionRegistry(ttl=0, prune_interval=0.01)
+    registry.get('a')
+    registry.start()
+    await asyncio.sleep(0.05)
+    assert 'a' not in registry and registry.stats['ttl'] == 1
+    await registry.close()
+    assert registry._prune_task is None
+
+
+async def test_hibernate_idle_pages(tmp_path):
+    registry = SessionRegistry(hibernate_after=0, spill_dir=str(tmp_path))
+    session = registry.get('s1')
+    watched, idle = session.page('/watched'), session.page('/idle')
+    for page in (watched, idle):
+        await _save_titles(page, ['a'])
+    sub = watched.subscribe()
+    registry.prune()
+    assert idle.hibernated and not watched.hibernated
+    assert idle.memory_size() == 0 and len(list(tmp_path.iterdir())) == 1
+    await _save_titles(idle, ['b'])
+    assert not idle.hibernated and idle.seq == 2
+    assert idle.data == {'card': {'d': {'view': 'markdown', 'title': 'b'}}}
+    registry.prune()
+    assert idle.hibernated
+    registry.evict('s1')
+    assert list(tmp_path.iterdir()) == []
+    watched.unsubscribe(sub)
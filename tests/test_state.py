@@ -0,0 +1,83 @@
+from wavegui import ui, data
+from wavegui.session import AsyncPage
+import pytest
+from wavegui.state import PageState, packer
+
+
+def _state(*ops):
+    state = PageState()
+    state.apply(list(ops))
+    return state
+
+
+def test_put_and_delete_cards():
+    state = _state({'k': 'a', 'd': {'title': 'a'}}, {'k': 'b', 'd': {'title': 'b'}}, {'k': 'a'})
+    assert state.cards == {'b': {'d': {'title': 'b'}}}
+    state.apply_op({})
+    assert state.cards == {}
+
+
+def test_ref_paths():
+    op = {'k': 'card', 'd': {'title': 'a', 'items': [{'textbox': {'name': 'tb', 'value': ''}}]}}
+    state = _state(op, {'k': 'card title', 'v': 'b'}, {'k': 'card items 0 textbox value', 'v': 'x'},
+                   {'k': 'card tb label', 'v': 'Label'}, {'k': 'card missing deep', 'v': 1})
+    assert state.cards['card']['d'] == {'title': 'b', 'items': [{'textbox': {'name': 'tb', 'value': 'x', 'label': 'Label'}}]}
+    # the op that put the card is left untouched.
+    assert op['d']['title'] == 'a'
+    state.apply_op({'k': 'card title', 'v': None})
+    assert 'title' not in state.cards['card']['d']
+
+
+def test_data_buffers():
+    page = AsyncPage('/test')
+    page['plot'] = ui.plot_card(box='1 1 2 2', title='', data=data('x y', 2), plot=ui.plot([]))
+    page['plot'].data[0] = [1, 2]
+    page['plot'].data[1].y = 3
+    ops = page._get_diff()
+    state = _state(*ops)
+    assert state.cards['plot']['b'] == [{'f': {'f': ['x', 'y'], 'n': 2, 'd': [[1, 2], None]}}]
+    state.apply_op({'k': 'plot data 0 y', 'v': 5})
+    assert state.cards['plot']['b'][0]['f']['d'][0] == [1, 5]
+
+
+def test_cyclic_and_list_append():
+    state = _state({'k': 'c', 'd': {'~data': 0}, 'b': [{'c': {'f': ['x'], 'n': 2}}]},
+                   {'k': 'l', 'd': {'~data': 0}, 'b': [{'l': {'f': ['x'], 'n': 0}}]})
+    for i in range(3):
+        state.apply_op({'k': 'c data __append__', 'v': [i]})
+        state.apply_op({'k': 'l data __append__', 'v': [i]})
+    assert state.cards['c']['b'][0]['c']['d'] == [[2], [1]]
+    assert state.cards['c']['b'][0]['c']['i'] == 1
+    assert state.cards['l']['b'][0]['l']['d'] == [[0], [1], [2]]
+
+
+def test_map_buffer():
+    state = _state({'k': 'm', 'd': {'~data': 0}, 'b': [{'m': {'f': ['x'], 'd': {'a': [1]}}}]},
+                   {'k': 'm data b', 'v': [2]}, {'k': 'm data a', 'v': None}, {'k': 'm data c', 'v': [1, 2]})
+    assert state.cards['m']['b'][0]['m']['d'] == {'b': [2]}
+
+
+async def test_page_snapshot_has_ref_updates():
+    page = AsyncPage('/test')
+    page['card'] = ui.markdown_card(box='1 1 2 2', title='a', content='')
+    await page.save()
+    page['card'].title = 'b'
+    await page.save()
+    assert page.data['card']['d']['title'] == 'b'
+
+
+@pytest.mark.parametrize('method', ['raw', 'zlib'])
+def test_compact_inflates_changed_card_only(method):
+    state = _state({'k': 'a', 'd': {'title': 'a'}}, {'k': 'b', 'd': {'title': 'b', 'items': []}})
+    state.compact(*packer(method))
+    assert state.cards == {} and set(state.packed) == {'a', 'b'}
+    state.apply_op({'k': 'b title', 'v': 'B'})
+    assert set(state.packed) == {'a'}
+    assert state.all_cards() == {'a': {'d': {'title': 'a'}}, 'b': {'d': {'title': 'B', 'items': []}}}
+    state.apply_op({'k': 'a'})
+    assert state.packed == {}
+
+
+def test_unknown_compaction():
+    with pytest.raises(ValueError):
+        packer('lz4')
@@ -0,0 +1,147 @@
+import asyncio
+import sqlite3
+import pytest
+from wavegui import codec
+from wavegui.session import SessionRegistry
+from wavegui.store import MemoryStore, SQLiteStore, SessionRecord
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        store = MemoryStore()
+    else:
+        store = SQLiteStore(str(tmp_path / 'sessions.db'))
+    yield store
+    store.close()
+
+
+def test_store_roundtrip(store):
+    assert store.load('a') is None
+    store.save({'a': SessionRecord(b'user', {'/': b'{}', '/x': b'[]'})})
+    record = store.load('a')
+    assert record.user == b'user' and record.pages == {'/': b'{}', '/x': b'[]'}
+    store.save({'a': SessionRecord(None, {'/x': b'1'}, updated=1)})
+    record = store.load('a')
+    assert record.user is None and record.pages == {'/x': b'1'}
+    assert store.expire(60) == 1
+    assert store.load('a') is None
+
+
+async def test_registry_reads_through_store(store):
+    registry = SessionRegistry(store=store, flush_interval=0.01)
+    session = registry.get('s1')
+    session.user.name = 'ann'
+    page = session.page('/')
+    page['card'] = {'view': 'markdown', 'title': 'a'}
+    await page.save()
+    await registry.flush()
+    assert registry.stats['flushed'] == 1
+
+    other = SessionRegistry(store=store)
+    restored = other.get('s1')
+    assert restored.user.name == 'ann'
+    assert restored.page('/').seq == 1
+    assert codec.loads(restored.page('/').snapshot()) == {'p': {'c': {'card': {'d': {'view': 'markdown', 'title': 'a'}}}}, 's': 1,
+                                                          'e': page.epoch}
+    assert restored.page('/').epoch == page.epoch
+    assert other.stats['loaded'] == 1
+
+
+async def test_registry_preloads_off_the_loop(store):
+    store.save({'s1': SessionRecord(codec.dumpb({'name': 'ann'}), {})})
+    registry = SessionRegistry(store=store)
+    await registry.preload('s1')
+    await registry.preload('s2')
+    assert 's1' in registry and 's2' not in registry
+    assert registry.get('s1').user.name == 'ann' and registry.stats['loaded'] == 1
+
+
+def test_user_data_is_never_unpickled(store):
+    import pickle
+    store.save({'s1': SessionRecord(pickle.dumps({'name': 'ann'}), {})})
+    session = SessionRegistry(store=store).get('s1')
+    assert session.user.name is None
+
+
+async def test_evicted_session_reloaded_before_flush():
+    store = MemoryStore()
+    registry = SessionRegistry(store=store, flush_interval=60)
+    page = registry.get('s1').page('/')
+    page['card'] = {'view': 'markdown', 'title': 'a'}
+    await page.save()
+    registry.evict('s1')
+    assert len(store) == 0
+    assert registry.get('s1').page('/').seq == 1
+    await registry.flush()
+    assert len(store) == 1
+
+
+async def test_warm_restart_restores_pages_lazily():
+    store = MemoryStore()
+    registry = SessionRegistry(store=store, flush_interval=60)
+    session = registry.get('s1')
+    for route in ('/a', '/b'):
+        page = session.page(route)
+        page['card'] = {'view': 'markdown', 'title': route}
+        await page.save()
+    wall = session.page('/wall', 'broadcast')
+    wall['card'] = {'view': 'markdown', 'title': 'wall'}
+    await wall.save()
+    await registry.close()
+    assert store.load('s1').pages['/a'][:1] != b'{'
+
+    restarted = SessionRegistry(store=store)
+    session = restarted.get('s1')
+    assert session.pages == {}
+    assert session.page('/a').data == {'card': {'d': {'view': 'markdown', 'title': '/a'}}}
+    assert list(session.pages) == ['/a']
+    assert session.to_record().pages == store.load('s1').pages
+    assert session.page('/wall', 'broadcast').seq == 1
+
+
+def test_sqlite_load_does_not_wait_for_save(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'sessions.db'))
+    store.save({'a': SessionRecord(b'user', {'/': b'{}'})})
+    lock, db, _, _ = store._open()
+    # a batch write in progress holds the write connection.
+    with lock:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM pages')
+        assert store.load('a').pages == {'/': b'{}'}
+        db.execute('ROLLBACK')
+    store.close()
+
+
+def test_sqlite_connections_are_opened_per_process(tmp_path, monkeypatch):
+    store = SQLiteStore(str(tmp_path / 'sessions.db'))
+    assert store._connections == {}
+    store.save({'a': SessionRecord(None, {})})
+    parent = store._open()
+    # a forked worker opens its own connections, those of its parent are never used.
+    monkeypatch.setattr('wavegui.store.os.getpid', lambda: -1)
+    assert store.load('a') is not None
+    assert store._open() is not parent and len(store._connections) == 2
+    store.close()
+    monkeypatch.undo()
+    assert store._open() is parent
+    store.close()
+
+
+async def test_registry_expires_and_closes_store(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'sessions.db'))
+    store.save({'old': SessionRecord(b'user', {}, updated=1)})
+    registry = SessionRegistry(store=store, store_ttl=60, prune_interval=0.01)
+    registry.get('s1').user.name = 'ann'
+    registry.start()
+    await asyncio.sleep(0.05)
+    assert registry.stats['expired'] == 1 and store.load('old') is None
+    # evicted sessions are written again, their stored record may have expired.
+    registry.evict('s1')
+    db = store._open()[1]
+    await registry.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
+    reopened = SQLiteStore(str(tmp_path / 'sessions.db'))
+    assert reopened.load('s1') is not None
+    reopened.close()
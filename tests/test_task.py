@@ -0,0 +1,222 @@
+import asyncio
+import pytest
+from wavegui.exception import TaskRejectedError, DeadlineExceededError
+from wavegui.task import AsyncPool, ProcessPool, Scheduler, TaskManager, TimerWheel, remaining, set_deadline, reset_deadline
+
+
+async def _work(result, delay=0.01):
+    await asyncio.sleep(delay)
+    return result
+
+
+async def test_spawn_does_not_wait_for_a_slot():
+    pool = AsyncPool(size=1, max_pending=2)
+    handles = [await pool.spawn(_work(i)) for i in range(3)]
+    assert len(pool.active) == 1 and len(pool.waiting) == 2
+    assert [await h for h in handles] == [0, 1, 2]
+    assert pool.is_empty and pool.stats['completed'] == 3
+
+
+async def test_overflow_reject():
+    pool = AsyncPool(size=1, max_pending=1)
+    await pool.spawn(_work(0))
+    await pool.spawn(_work(1))
+    with pytest.raises(TaskRejectedError):
+        await pool.spawn(_work(2))
+    assert pool.stats['rejected'] == 1
+    await pool.join()
+
+
+async def test_overflow_drop_oldest():
+    pool = AsyncPool(size=1, max_pending=1, overflow='drop_oldest')
+    first = await pool.spawn(_work(0))
+    dropped = await pool.spawn(_work(1))
+    last = await pool.spawn(_work(2))
+    with pytest.raises(asyncio.CancelledError):
+        await dropped
+    assert await first == 0 and await last == 2
+
+
+async def test_overflow_caller_runs():
+    pool = AsyncPool(size=1, max_pending=0, overflow='caller_runs')
+    running = await pool.spawn(_work(0, 0.05))
+    handle = await pool.spawn(_work(1))
+    assert handle.done() and handle.result() == 1 and not running.done()
+    assert pool.stats['caller_runs'] == 1
+    await running
+
+
+async def test_cancel_running_and_pending():
+    pool = AsyncPool(size=1, max_pending=1)
+    running = await pool.spawn(_work(0, 1))
+    pending = await pool.spawn(_work(1))
+    pending.cancel()
+    await asyncio.sleep(0)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+    assert pending.done() and pool.is_empty
+    assert pool.stats['cancelled'] == 1
+
+
+async def test_cancel_before_the_task_starts():
+    scheduler = Scheduler(max_running=1)
+    pool = AsyncPool(size=2, scheduler=scheduler)
+    started = await pool.spawn(_work(0))
+    queued = await pool.spawn(_work(1))
+    # no yield: the task of `started` exists but has not run yet.
+    started.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await started
+    assert await queued == 1
+    assert pool.is_empty and scheduler.running == 0
+    assert pool.stats['cancelled'] == 1 and pool.reasons == {'cancelled': 1}
+
+
+async def test_task_deadline():
+    pool = AsyncPool(size=1, max_pending=1)
+    slow = await pool.spawn(_work(0, 1), timeout=0.02)
+    # the deadline counts the wait in the queue too.
+    queued = await pool.spawn(_work(1, 0.01), timeout=0.01)
+    with pytest.raises(DeadlineExceededError):
+        await slow
+    with pytest.raises(DeadlineExceededError):
+        await queued
+    assert slow.reason == queued.reason == 'deadline'
+    assert pool.stats['deadline'] == 2 and pool.reasons == {'deadline': 2}
+
+
+async def test_deadline_propagates_to_child_tasks():
+    pool = AsyncPool(size=2)
+    seen = []
+
+    async def child():
+        seen.append(remaining())
+
+    async def parent():
+        seen.append(remaining())
+        await (await pool.spawn(child(), timeout=10))
+
+    await (await pool.spawn(parent(), timeout=0.5))
+    assert 0 < seen[1] <= seen[0] <= 0.5
+    token = set_deadline(1)
+    try:
+        assert 0 < remaining() <= 1
+    finally:
+        reset_deadline(token)
+    assert remaining() is None
+
+
+async def test_deadline_not_inherited_through_shared_scheduler():
+    scheduler = Scheduler(max_running=1)
+    a, b = AsyncPool(scheduler=scheduler, name='a'), AsyncPool(scheduler=scheduler, name='b')
+    seen = []
+
+    async def other():
+        seen.append(remaining())
+
+    token = set_deadline(1)
+    try:
+        first = await a.spawn(_work(0))
+    finally:
+        reset_deadline(token)
+    # waits for the slot of `first`, and is started from its task when it finishes.
+    second = await b.spawn(other())
+    await first
+    await second
+    assert seen == [None]
+
+
+async def test_cancel_all_records_reason():
+    manager = TaskManager('t', pool_size=1, scheduler=None)
+    running = await manager.spawn(_work(0, 1))
+    pending = await manager.spawn(_work(1))
+    await asyncio.sleep(0)
+    await manager.cancel('disconnect')
+    assert running.done() and pending.done() and manager.pool.is_empty
+    assert running.reason == pending.reason == 'disconnect'
+    assert manager.pool.reasons == {'disconnect': 2}
+
+
+async def test_closed_pool_rejects_tasks():
+    manager = TaskManager('t', pool_size=1, scheduler=None)
+    running = await manager.spawn(_work(0, 1))
+    await manager.close('disconnect')
+    assert running.reason == 'disconnect' and manager.pool.closed == 'disconnect'
+    with pytest.raises(TaskRejectedError):
+        await manager.spawn(_work(1))
+    assert manager.pool.stats['rejected'] == 1
+
+
+async def test_scheduler_round_robin_and_priority():
+    scheduler = Scheduler(max_running=1, weights={'b': 2})
+    pools = {name: AsyncPool(size=10, scheduler=scheduler, name=name) for name in 'abc'}
+    order = []
+
+    async def work(tag):
+        order.append(tag)
+        await asyncio.sleep(0)
+
+    handles = [await pools['a'].spawn(work('a0'))]
+    for i in range(1, 3):
+        handles.append(await pools['a'].spawn(work(f'a{i}')))
+    for i in range(3):
+        handles.append(await pools['b'].spawn(work(f'b{i}')))
+    handles.append(await pools['c'].spawn(work('c0'), priority='interactive'))
+    assert scheduler.queued() == 6
+    for h in handles:
+        await h
+    assert order == ['a0', 'c0', 'a1', 'b0', 'b1', 'a2', 'b2']
+    report = scheduler.report()
+    assert report['running'] == 0 and report['classes']['interactive']['started'] == 1
+
+
+async def test_scheduler_skips_cancelled():
+    scheduler = Scheduler(max_running=1)
+    pool = AsyncPool(size=2, scheduler=scheduler, name='a')
+    first = await pool.spawn(_work(0))
+    waiting = await pool.spawn(_work(1))
+    waiting.cancel()
+    assert len(pool.active) == 1
+    assert await first == 0
+    assert scheduler.running == 0 and scheduler.queued() == 0
+
+
+async def test_process_pool():
+    pool = ProcessPool(size=2, preload=['json'])
+    try:
+        assert len(await pool.start()) == 2
+        assert await pool.run(pow, 2, 10) == 1024
+        assert await pool.run(sorted, [3, 1, 2], reverse=True) == [3, 2, 1]
+        with pytest.raises(ZeroDivisionError):
+            await pool.run(divmod, 1, 0)
+        assert pool.stats['calls'] == 2 and pool.stats['failed'] == 1
+        name, queued, ran = pool.calls[-1]
+        assert name == 'sorted' and queued >= 0 and ran >= 0
+    finally:
+        pool.shutdown()
+
+
+async def test_timer_wheel_batches_and_pauses():
+    wheel = TimerWheel(tick=0.01, slots=4)
+    runs = []
+    active = [True]
+
+    async def tick(name):
+        runs.append(name)
+
+    a = wheel.schedule(0.02, lambda: tick('a'))
+    b = wheel.schedule(0.02, lambda: tick('b'), active=lambda: active[0])
+    # further than the slots of the wheel ahead.
+    far = wheel.schedule(0.06, lambda: runs.append('far'))
+    await asyncio.sleep(0.05)
+    assert runs.count('a') >= 1 and runs.count('a') == runs.count('b')
+    assert wheel.stats['batches'] < wheel.stats['fired']
+    active[0] = False
+    await asyncio.sleep(0.05)
+    assert b.skipped > 0 and runs.count('a') > runs.count('b')
+    assert 'far' in runs
+    for timer in (a, b, far):
+        timer.cancel()
+    await asyncio.sleep(0.02)
+    assert wheel.timers == 0 and wheel._task is None
@@ -0,0 +1,155 @@
+"""
+Server-wide cache of computed results.
+
+Sessions that ask for the same expensive result, e.g. the same report, share one computation: a result is kept
+for `ttl` seconds, the least recently used results are evicted above `max_entries`, and callers asking for a key
+that is being computed wait for that computation instead of starting another.
+
+    from wavegui import WaveApp
+    WaveApp.config_cache(max_entries=1024, ttl=60)
+
+    report = await q.cached_run(('report', day), build_report, day)
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class ResultCache:
+    """
+    A TTL and LRU bounded cache of results, with single-flight computation of missing ones.
+
+    Args:
+        max_entries: Maximum number of results kept, the least recently used are evicted first.
+        ttl: Seconds a result is kept, None to keep it until evicted.
+
+    `stats` counts `hits`, `misses`, `coalesced` calls that waited for a computation already running,
+    `evicted` and `expired` results, and `failed` computations, which are not cached.
+    """
+    default = None
+
+    def __init__(self, max_entries=1024, ttl: Optional[float] = 60):
+        if max_entries <= 0:
+            raise ValueError('max_entries must be positive.')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = dict(hits=0, misses=0, coalesced=0, evicted=0, expired=0, failed=0)
+        # key -> (expiry, result), least recently used first.
+        self._entries = OrderedDict()
+        self._running = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def report(self) -> dict:
+        calls = self.stats['hits'] + self.stats['misses'] + self.stats['coalesced']
+        return dict(self.stats, entries=len(self._entries), running=len(self._running),
+                    hit_rate=(self.stats['hits'] + self.stats['coalesced']) / calls if calls else 0.0)
+
+    def get(self, key: Hashable, default=None) -> Any:
+        """
+        The cached result of `key`, `default` if there is none. Does not count as a hit or a miss.
+        """
+        value = self._lookup(key)
+        return default if value is _missing else value
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _missing
+        expiry, value = entry
+        if expiry is not None and expiry <= time.monotonic():
+            del self._entries[key]
+            self.stats['expired'] += 1
+            return _missing
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = _missing):
+        """
+        Cache `value` for `key`, for `ttl` seconds instead of the cache's when provided.
+        """
+        ttl = self.ttl if ttl is _missing else ttl
+        self._entries[key] = (None if ttl is None else time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    def invalidate(self, key: Hashable):
+        """
+        Drop the result of `key`, a computation already running still finishes and is cached.
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_run(self, key: Hashable, compute: Callable[[], Awaitable], ttl: Optional[float] = _missing) -> Any:
+        """
+        The cached result of `key`, else the result of `compute()`, cached. Concurrent calls for the same key
+        share one `compute()`, which keeps running for the others when a caller is cancelled.
+        Exceptions are raised to every waiting caller and are not cached.
+        """
+        value = self._lookup(key)
+        if value is not _missing:
+            self.stats['hits'] += 1
+            return value
+        future = self._running.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+        else:
+            self.stats['misses'] += 1
+            # the computation is shared, it runs without the context of the caller, e.g. its deadline.
+            future = self._running[key] = contextvars.Context().run(asyncio.ensure_future, compute())
+            future.add_done_callback(functools.partial(self._done, key, ttl))
+        return await asyncio.shield(future)
+
+    def _done(self, key, ttl, future):
+        if self._running.get(key) is future:
+            del self._running[key]
+        if future.cancelled():
+            return
+        ex = future.exception()
+        if ex is not None:
+            self.stats['failed'] += 1
+            logger.debug(f'computing {key!r} failed: {ex!r}.')
+            return
+        self.put(key, future.result(), ttl)
+
+
+def cached(key: Callable[..., Hashable] = None, ttl: Optional[float] = _missing, cache: ResultCache = None):
+    """
+    Cache the results of an async function in `cache`, the server's `ResultCache` if not provided.
+    Results are keyed by the function and its arguments, or by `key(*args, **kwargs)` when provided.
+
+        @cached(ttl=30)
+        async def load_report(day):
+            ...
+    """
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = (name, key(*args, **kwargs)) if key is not None else (name, args, tuple(sorted(kwargs.items())))
+            return await (cache or default_cache()).get_or_run(k, lambda: func(*args, **kwargs), ttl)
+        return wrapper
+    return decorator
+
+
+def default_cache() -> ResultCache:
+    """
+    The server-wide cache, see `WaveApp.config_cache`.
+    """
+    if ResultCache.default is None:
+        ResultCache.default = ResultCache()
+    return ResultCache.default
@@ -0,0 +1,183 @@
+"""
+JSON codec used for everything wavegui encodes or decodes.
+
+orjson is used when installed, stdlib json otherwise. Both produce the same
+compact UTF-8 JSON (no whitespace, non-ASCII left unescaped, floats written the
+way orjson writes them) and accept the same types: JSON types, tuples, enums and
+UUIDs. Anything else, e.g. datetimes, dataclasses or numpy values, raises
+TypeError with either, so an app never depends on which one is installed.
+NaN and Infinity, which JSON has no value for, are written as null by both.
+
+msgspec is available with `codec.use('msgspec')`. It also encodes datetimes,
+dataclasses and bytes natively, which the others reject, so it is never
+selected by default.
+
+Select a backend once, before serving:
+
+    from wavegui import codec
+    codec.use('json')
+"""
+import json
+import logging
+import re
+from enum import Enum
+from uuid import UUID
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+logger = logging.getLogger(__name__)
+
+
+def _reject(obj):
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _default(obj):
+    # the types orjson encodes natively.
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, Enum):
+        return obj.value
+    _reject(obj)
+
+
+_exponent = re.compile(r'\de[+-]\d|NaN|Infinity')
+_float_or_string = re.compile(r'"(?:[^"\\]|\\.)*"|(-?\d)(?:\.(\d+))?e([+-])(\d+)|(-?Infinity|NaN)')
+
+
+def _orjson_float(m):
+    if m.group(5) is not None:
+        return 'null'
+    if m.group(1) is None:
+        return m.group(0)
+    mantissa, fraction, sign, exponent = m.group(1), m.group(2) or '', m.group(3), int(m.group(4))
+    if sign == '-' and exponent == 5:
+        # orjson writes these without an exponent.
+        return mantissa[:-1] + '0.0000' + mantissa[-1] + fraction
+    return mantissa + ('.' + fraction if fraction else '') + 'e' + ('-' if sign == '-' else '') + str(exponent)
+
+
+def _json_dumps(obj):
+    s = json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default)
+    # repr writes 1e+20 and 1e-07 where orjson writes 1e20 and 1e-7, and NaN where orjson writes null.
+    if _exponent.search(s):
+        s = _float_or_string.sub(_orjson_float, s)
+    return s
+
+
+def _json_dumpb(obj):
+    return _json_dumps(obj).encode('utf-8')
+
+
+def _json_loads(s):
+    return json.loads(s)
+
+
+_orjson_options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+                   if orjson else 0)
+
+
+def _orjson_dumpb(obj):
+    try:
+        return orjson.dumps(obj, default=_reject, option=_orjson_options)
+    except orjson.JSONEncodeError:
+        # e.g. integers wider than 64 bits, stdlib handles them or raises the same TypeError.
+        return _json_dumpb(obj)
+
+
+def _orjson_dumps(obj):
+    return _orjson_dumpb(obj).decode('utf-8')
+
+
+def _orjson_loads(s):
+    return orjson.loads(s)
+
+
+_msgspec_encoder = msgspec.json.Encoder(enc_hook=_reject) if msgspec else None
+_msgspec_decoder = msgspec.json.Decoder() if msgspec else None
+
+
+def _msgspec_dumpb(obj):
+    try:
+        return _msgspec_encoder.encode(obj)
+    except (TypeError, OverflowError, msgspec.EncodeError):
+        return _json_dumpb(obj)
+
+
+def _msgspec_dumps(obj):
+    return _msgspec_dumpb(obj).decode('utf-8')
+
+
+def _msgspec_loads(s):
+    try:
+        return _msgspec_decoder.decode(s)
+    except msgspec.DecodeError as ex:
+        raise ValueError(str(ex)) from ex
+
+
+_backends = {
+    'json': (_json_dumps, _json_dumpb, _json_loads),
+}
+if orjson is not None:
+    _backends['orjson'] = (_orjson_dumps, _orjson_dumpb, _orjson_loads)
+if msgspec is not None:
+    _backends['msgspec'] = (_msgspec_dumps, _msgspec_dumpb, _msgspec_loads)
+
+_name = None
+_dumps = _dumpb = _loads = None
+
+
+def use(name: str = None):
+    """
+    Select the JSON backend.
+
+    Args:
+        name: One of 'orjson', 'msgspec' or 'json'. If not provided, orjson if installed, else json.
+    """
+    global _name, _dumps, _dumpb, _loads
+    if name is None:
+        name = 'orjson' if 'orjson' in _backends else 'json'
+    if name not in _backends:
+        raise ValueError(f'JSON backend {name} is not available.')
+    _name = name
+    _dumps, _dumpb, _loads = _backends[name]
+    logger.debug(f'using {name} json backend.')
+
+
+def backend() -> str:
+    """
+    Name of the JSON backend in use.
+    """
+    return _name
+
+
+def dumps(obj) -> str:
+    """
+    Encode to a JSON string.
+    """
+    return _dumps(obj)
+
+
+def dumpb(obj) -> bytes:
+    """
+    Encode to UTF-8 JSON bytes.
+    """
+    return _dumpb(obj)
+
+
+def loads(s):
+    """
+    Decode a JSON string or bytes. Raises ValueError for malformed input.
+    """
+    return _loads(s)
+
+
+use()
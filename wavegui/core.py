@@ -31,6 +31,8 @@ from typing import List, Dict, Union, Tuple, Any, Optional, IO
 
 import httpx
 
+from . import codec
+
 logger = logging.getLogger(__name__)
 
 Primitive = Union[bool, str, int, float, None]
@@ -469,19 +471,94 @@ class _ServerCache(_ServerCacheBase):
             raise ServiceError(f'Request failed (code={res.status_code}): {res.text}')
 
 
+def _is_path_key(k: Any) -> bool:
+    return _is_str(k) and k.split() == [k]
+
+
+def _diff_value(path: str, old: Any, new: Any, ops: list, limit: int) -> bool:
+    if old == new:
+        return True
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k, v in new.items():
+            if not _is_path_key(k) or k.startswith('~'):
+                return False
+            if k not in old:
+                ops.append(dict(k=path + _key_sep + k, v=v))
+            elif not _diff_value(path + _key_sep + k, old[k], v, ops, limit):
+                return False
+            if len(ops) > limit:
+                return False
+        for k in old:
+            if k not in new:
+                if not _is_path_key(k):
+                    return False
+                ops.append(dict(k=path + _key_sep + k, v=None))
+        return len(ops) <= limit
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (o, n) in enumerate(zip(old, new)):
+            if not _diff_value(path + _key_sep + str(i), o, n, ops, limit):
+                return False
+        return len(ops) <= limit
+    if _key_sep not in path:
+        # a card itself can only be replaced with a full put.
+        return False
+    ops.append(dict(k=path, v=new))
+    return len(ops) <= limit
+
+
+def _component_names(items: Any, names: set):
+    if not isinstance(items, list):
+        return
+    for item in items:
+        if isinstance(item, dict):
+            for c in item.values():
+                if isinstance(c, dict):
+                    if c.get('name'):
+                        names.add(c['name'])
+                    for k in ('items', 'secondary_items', 'buttons'):
+                        _component_names(c.get(k), names)
+
+
+def _diff_card(key: str, old: dict, new: dict, limit: int) -> Optional[list]:
+    """
+    Ref ops turning card `old` into `new`, or None if a full put is as good.
+    """
+    ops = []
+    if not _diff_value(key, old, new, ops, limit):
+        return None
+    # the client resolves `card <name> <attr>` to the component called <name>, so paths like that are ambiguous.
+    names = set()
+    for k in ('items', 'secondary_items', 'buttons'):
+        _component_names(new.get(k), names)
+    for op in ops:
+        parts = op['k'].split(_key_sep)
+        if len(parts) == 3 and parts[1] in names:
+            return None
+    if ops and len(marshal(ops)) >= len(marshal(new)):
+        return None
+    return ops
+
+
 class PageBase:
     """
     Represents a remote page.
 
     Args:
         url: The URL of the remote page.
+
+    Set ``diff_cards`` to True to send only the changed parts of a card that is added again under the same key.
     """
 
+    diff_cards = False
+    diff_max_ops = 32
+
     def __init__(self, url: str):
         self.url = url
         self._changes = []
         # HACK: Overloading += operator makes unnecessary __setattr__ call. Skip it to prevent redundant ops.
         self._skip_next_track = False
+        # the last card added under each key, while no other op changed it.
+        self._cards = {}
 
     def add(self, key: str, card: Any) -> Ref:
         """
@@ -518,6 +595,15 @@ class PageBase:
 
         if len(bufs) > 0:
             self._track(dict(k=key, d=props, b=bufs))
+        elif self.diff_cards:
+            prev = self._cards.get(key)
+            ops = None if prev is None else _diff_card(key, prev, props, self.diff_max_ops)
+            if ops is None:
+                self._track(dict(k=key, d=props))
+            else:
+                for op in ops:
+                    self._track(op)
+            self._cards[key] = props
         else:
             self._track(dict(k=key, d=props))
 
@@ -527,6 +613,12 @@ class PageBase:
         if self._skip_next_track:
             self._skip_next_track = False
             return
+        if self._cards:
+            k = op.get('k')
+            if k:
+                self._cards.pop(k.split(_key_sep, 1)[0], None)
+            else:
+                self._cards.clear()
         self._changes.append(op)
 
     def _diff(self):
@@ -1118,7 +1210,7 @@ def marshal(d: Any) -> str:
     Returns:
         A string containing the JSON-serialized form.
     """
-    return json.dumps(d, allow_nan=False, separators=(',', ':'))
+    return codec.dumps(d)
 
 
 def unmarshal(s: str) -> Any:
@@ -1131,7 +1223,7 @@ def unmarshal(s: str) -> Any:
     Returns:
         The deserialized object or value.
     """
-    return json.loads(s)
+    return codec.loads(s)
 
 
 def pack(data: Any) -> str:
@@ -0,0 +1,221 @@
+"""
+Multi-process serving.
+
+`run_workers` forks worker processes, each running the app with uvicorn on its own unix socket, and runs
+a `Dispatcher` in the parent that accepts the TCP connections. The dispatcher reads the head of the first
+request of a connection, takes the session id from the signed session cookie and hashes it to a worker,
+then copies bytes in both directions. All connections of a browser session land on the same worker,
+so its pages and `q.user` stay in the memory of that worker. Requests without a session cookie are
+spread round robin. Multicast and broadcast pages are shared within one process, they are not served by workers.
+
+    WaveServer.run(workers=4)
+"""
+import asyncio
+from base64 import b64decode
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import zlib
+from typing import List, Optional
+
+from itsdangerous import TimestampSigner, BadSignature
+from starlette.requests import cookie_parser
+
+logger = logging.getLogger(__name__)
+
+_head_end = b'\r\n\r\n'
+_bad_request = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+_unavailable = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+def session_id_from_cookie(cookie_header: str, session_cookie: str, secret_key: str, max_age=None) -> Optional[str]:
+    """
+    The session id in a `Cookie` header, signed the same way as by starlette's `SessionMiddleware`.
+    """
+    data = cookie_parser(cookie_header).get(session_cookie)
+    if not data:
+        return None
+    try:
+        data = TimestampSigner(str(secret_key)).unsign(data.encode('utf-8'), max_age=max_age)
+        session = json.loads(b64decode(data))
+    except (BadSignature, ValueError):
+        return None
+    return session.get('session_id') if isinstance(session, dict) else None
+
+
+def worker_index(session_id: str, workers: int) -> int:
+    """
+    The worker of a session, the same in every process and run.
+    """
+    return zlib.crc32(session_id.encode('utf-8')) % workers
+
+
+def _cookie_header(head: bytes) -> str:
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'cookie':
+            return value.strip().decode('latin-1')
+    return ''
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        writer.close()
+
+
+class Dispatcher:
+    """
+    Routes TCP connections to the worker of their session.
+
+    Args:
+        sockets: Unix socket path of every worker.
+        session_cookie: Name of the session cookie.
+        secret_key: Key the session cookie is signed with.
+        max_age: Maximum age of the session cookie in seconds.
+        connect_timeout: Seconds to wait for a worker to accept, e.g. while it restarts.
+    """
+
+    def __init__(self, sockets: List[str], session_cookie='wave-session', secret_key='wavegui_secret',
+                 max_age=None, connect_timeout=5):
+        self.sockets = sockets
+        self.session_cookie = session_cookie
+        self.secret_key = secret_key
+        self.max_age = max_age
+        self.connect_timeout = connect_timeout
+        self.stats = dict(connections=0, affine=0, failed=0)
+        self._next = 0
+
+    def route(self, head: bytes) -> int:
+        session_id = session_id_from_cookie(_cookie_header(head), self.session_cookie, self.secret_key, self.max_age)
+        if session_id is not None:
+            self.stats['affine'] += 1
+            return worker_index(session_id, len(self.sockets))
+        self._next = (self._next + 1) % len(self.sockets)
+        return self._next
+
+    async def _connect(self, path):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(path)
+            except (ConnectionError, FileNotFoundError):
+                if loop.time() >= deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats['connections'] += 1
+        try:
+            try:
+                head = await reader.readuntil(_head_end)
+            except asyncio.LimitOverrunError:
+                writer.write(_bad_request)
+                return
+            except asyncio.IncompleteReadError:
+                return
+            worker = self.route(head)
+            try:
+                upstream_reader, upstream_writer = await self._connect(self.sockets[worker])
+            except (ConnectionError, OSError):
+                logger.error(f'worker {worker} is not accepting connections.')
+                self.stats['failed'] += 1
+                writer.write(_unavailable)
+                return
+            upstream_writer.write(head)
+            await asyncio.gather(_pipe(reader, upstream_writer), _pipe(upstream_reader, writer))
+            upstream_writer.close()
+        finally:
+            writer.close()
+
+    async def serve(self, host='0.0.0.0', port=8000):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def _run_worker(app, path, log_level):
+    import uvicorn
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    uvicorn.run(app, uds=path, log_level=log_level)
+
+
+class _Supervisor:
+    def __init__(self, app, sockets, log_level):
+        self.app = app
+        self.sockets = sockets
+        self.log_level = log_level
+        self._context = multiprocessing.get_context('fork')
+        self.processes = [None] * len(sockets)
+
+    def start(self, i):
+        if os.path.exists(self.sockets[i]):
+            os.unlink(self.sockets[i])
+        process = self._context.Process(target=_run_worker, args=(self.app, self.sockets[i], self.log_level),
+                                        name=f'wavegui-worker-{i}', daemon=True)
+        process.start()
+        self.processes[i] = process
+
+    async def watch(self, interval=1):
+        while True:
+            await asyncio.sleep(interval)
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(f'worker {i} exited with {process.exitcode}, restarting.')
+                    self.start(i)
+
+    def stop(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(5)
+        for path in self.sockets:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def run_workers(app, workers: int, host='0.0.0.0', port=8000, log_level='info', socket_dir=None, **session_config):
+    """
+    Serve `app` with `workers` forked processes behind a `Dispatcher`. Blocks until interrupted.
+
+    Args:
+        app: The ASGI app, created before the workers are forked.
+        workers: Number of worker processes.
+        socket_dir: Directory of the worker sockets, a temporary one if not provided.
+        session_config: `session_cookie`, `secret_key` and `max_age` of the session cookie.
+    """
+    socket_dir = socket_dir or tempfile.mkdtemp(prefix='wavegui-')
+    sockets = [os.path.join(socket_dir, f'worker-{i}.sock') for i in range(workers)]
+    supervisor = _Supervisor(app, sockets, log_level)
+    for i in range(workers):
+        supervisor.start(i)
+    dispatcher = Dispatcher(sockets, **session_config)
+    logger.info(f'dispatching http://{host}:{port} to {workers} workers.')
+
+    async def main():
+        watcher = asyncio.ensure_future(supervisor.watch())
+        try:
+            await dispatcher.serve(host, port)
+        finally:
+            watcher.cancel()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
@@ -1,3 +1,4 @@
+import asyncio
 
 class NoHandlerException(Exception):
     pass
@@ -6,4 +7,16 @@ class RouteDuplicatedError(Exception):
     pass
 
 class AppNotFoundException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class SlowConsumerError(Exception):
+    pass
+
+class QuotaExceededError(Exception):
+    pass
+
+class TaskRejectedError(Exception):
+    pass
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    pass
@@ -1,7 +1,7 @@
-import json
 import math
 from typing import Union, Optional, List
 from .core import pack, data as _data, Data, Ref, Expando, expando_to_dict
+from . import codec
 
 
 # TODO add formal parameters for shape functions, including presentation attributes:
@@ -30,7 +30,7 @@ def scene(**kwargs) -> Data:
     Returns:
         A `h2o_wave.core.Data` instance.
     """
-    return _data(fields='d o', rows={k: [json.dumps(expando_to_dict(v)), ''] for k, v in kwargs.items()})
+    return _data(fields='d o', rows={k: [codec.dumps(expando_to_dict(v)), ''] for k, v in kwargs.items()})
 
 
 def draw(element: Ref, **kwargs) -> Ref:
@@ -43,7 +43,7 @@ def draw(element: Ref, **kwargs) -> Ref:
     Returns:
         The element reference, without change.
     """
-    element['o'] = json.dumps(kwargs)
+    element['o'] = codec.dumps(kwargs)
     return element
 
 
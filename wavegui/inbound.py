@@ -0,0 +1,100 @@
+"""
+Inbound request pipeline of a websocket client.
+
+Requests are handled off the socket read loop, one at a time and in arrival order within a lane.
+Every client has one lane, or one per route with `concurrent_routes`, so a slow handler on one route
+does not hold back the others. Repeated events from the same component can be coalesced: the last request
+waiting in its lane is replaced by a newer one with the same key, optionally after a debounce. Only the last one
+is, so coalescing never reorders the requests of a lane.
+"""
+import asyncio
+from collections import deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ('req', 'key', 'time')
+
+    def __init__(self, req, key, time):
+        self.req = req
+        self.key = key
+        self.time = time
+
+
+class _Lane:
+    __slots__ = ('pending', 'worker')
+
+    def __init__(self):
+        self.pending = deque()
+        self.worker = None
+
+
+class InboundPipeline:
+    """
+    Args:
+        handler: Coroutine function called with each request.
+        concurrent_routes: Give every route its own lane, running concurrently.
+        coalesce: Replace the last waiting request by a newer one with the same `req.coalesce_key()`.
+        debounce: Milliseconds a coalescable request waits for a newer one before it is handled.
+    """
+
+    def __init__(self, handler, concurrent_routes=False, coalesce=False, debounce=0):
+        self.handler = handler
+        self.concurrent_routes = concurrent_routes
+        self.coalesce = coalesce or debounce > 0
+        self.debounce = debounce / 1000
+        self.lanes = {}
+        self.stats = dict(received=0, handled=0, coalesced=0)
+
+    def submit(self, req):
+        self.stats['received'] += 1
+        lane_key = req.addr if self.concurrent_routes else ''
+        lane = self.lanes.get(lane_key)
+        if lane is None:
+            lane = self.lanes[lane_key] = _Lane()
+        key = req.coalesce_key() if self.coalesce else None
+        now = asyncio.get_event_loop().time()
+        if key is not None and lane.pending and lane.pending[-1].key == key:
+            entry = lane.pending[-1]
+            entry.req = req
+            entry.time = now
+            self.stats['coalesced'] += 1
+            return
+        lane.pending.append(_Entry(req, key, now))
+        if lane.worker is None:
+            lane.worker = asyncio.create_task(self._run(lane_key, lane))
+
+    async def _run(self, lane_key, lane):
+        loop = asyncio.get_event_loop()
+        try:
+            while lane.pending:
+                entry = lane.pending[0]
+                if entry.key is not None and self.debounce > 0:
+                    delay = entry.time + self.debounce - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                        continue
+                lane.pending.popleft()
+                try:
+                    await self.handler(entry.req)
+                except Exception:
+                    logger.exception('Unhandled exception in request handler')
+                self.stats['handled'] += 1
+        finally:
+            lane.worker = None
+            if not lane.pending and self.lanes.get(lane_key) is lane:
+                del self.lanes[lane_key]
+
+    def close(self):
+        """
+        Drop the waiting requests, requests being handled run to completion.
+        """
+        for lane in self.lanes.values():
+            lane.pending.clear()
+
+    async def join(self):
+        workers = [lane.worker for lane in self.lanes.values() if lane.worker is not None]
+        if workers:
+            await asyncio.wait(workers)
@@ -19,19 +19,24 @@ from starlette.types import Receive, Scope, Send
 import importlib.resources
 import traceback
 import logging
-import json
 import asyncio
 from asyncio import CancelledError
 from .utils import IDGenerator, sanitize
-from .core import UNICAST, Expando
+from .core import UNICAST, Expando, PageBase
 from .session import Query, Session, UserInfo
+from .quota import Quota
+from . import quota
 from .ui import facepile, markdown_card
-from .exception import NoHandlerException, RouteDuplicatedError, AppNotFoundException
-from .task import TaskManager
+from .exception import NoHandlerException, RouteDuplicatedError, AppNotFoundException, SlowConsumerError
+from .task import TaskManager, ProcessPool, TimerWheel, set_deadline, reset_deadline, DISCONNECT
+from .inbound import InboundPipeline
+from .dispatch import run_workers
+from .cache import ResultCache
 import aiofiles
 import aiofiles.os
 from functools import partial
 from .template import template
+from . import codec
 from mimetypes import guess_type as mimetypes_guess_type
 import typing
 
@@ -79,6 +84,7 @@ class MimeStaticFiles(StaticFiles):
         return response
 
 class ClientRequest:
+    __slots__ = ('action', 'addr', 'data', 'client', '_args')
     bad_request = object()
     invalid_request = object()
     action_map = {
@@ -104,26 +110,94 @@ class ClientRequest:
         self.addr = addr
         self.data = data
         self.client = client
+        self._args = None
 
     def json(self):
+        if self._args is None:
+            self._args = self._load_args()
+        return self._args
+
+    def _load_args(self):
         if not self.data:
             return {}
         try:
-            return json.loads(self.data)
+            args = codec.loads(self.data)
         except:
             return {'#': self.data}
+        return args if isinstance(args, dict) else {'#': self.data}
+
+    def coalesce_key(self):
+        """
+        Identifies the components a query reports on, None if it must not be replaced by a newer query.
+        """
+        if self.action != 'query':
+            return None
+        args = self.json()
+        if '#' in args:
+            return None
+        names = tuple(sorted(k for k in args if k != ''))
+        events = args.get('')
+        if isinstance(events, dict):
+            events = tuple(sorted((source, e) for source, v in events.items() if isinstance(v, dict) for e in v))
+        else:
+            events = ()
+        if not names and not events:
+            return None
+        return (self.addr, names, events)
+
+    def resume(self):
+        """
+        Page sequence number and epoch a reconnecting client already has, sent as `+ /route {"s": seq, "e": epoch}`.
+        """
+        args = self.json()
+        seq, epoch = args.get('s'), args.get('e')
+        if not isinstance(seq, int):
+            return None
+        return seq, epoch if isinstance(epoch, str) else None
 
 
 class WaveClient:
-    def __init__(self, websocket):
+    """
+    One websocket connection.
+
+    Options (defaults set with `WaveApp.config_client`, overridden per client by keyword arguments):
+        binary_frames: Send frames as binary. The wave browser client only reads text frames.
+        flush_window: Milliseconds to collect patches after the first one before sending, 0 to send at once.
+        max_batch: Maximum number of patches sent in one websocket frame.
+        concurrent_routes: Handle requests for different routes concurrently, see `InboundPipeline`.
+        coalesce_events: Handle only the latest of queries in a row from the same components.
+        debounce: Milliseconds a query waits for a newer one from the same components.
+        pool_size: Background tasks of the client running at once, see `Query.run_in_back`.
+        task_queue: Background tasks waiting for a free slot.
+        task_overflow: What spawning a task does when the queue is full, see `AsyncPool`.
+        handler_timeout: Seconds every handler has, inherited by its `q.exec` calls and background tasks,
+            None for no deadline, see `Query.remaining`.
+    """
+    _client_config = dict(binary_frames=False, flush_window=0, max_batch=64,
+        concurrent_routes=False, coalesce_events=False, debounce=0,
+        pool_size=5, task_queue=100, task_overflow='reject', handler_timeout=None)
+
+    def __init__(self, websocket, **kwargs):
         self.websocket = websocket
+        options = dict(self._client_config, **kwargs)
+        self.binary_frames = options['binary_frames']
+        self.flush_window = options['flush_window']
+        self.max_batch = options['max_batch']
+        self.handler_timeout = options['handler_timeout']
+        self.inbound = InboundPipeline(self.handle_request, concurrent_routes=options['concurrent_routes'],
+            coalesce=options['coalesce_events'], debounce=options['debounce'])
         self.sync_task = None
         self.quit = False
-        self.user_info = UserInfo()
+        self.user_info = UserInfo.from_scope(websocket.scope)
+        # the id signed into the session cookie by SessionMiddleware, a reconnecting browser gets its session back.
         session_id = websocket.scope.get('session', {}).get('session_id', None) or IDGenerator.create_session_id()
-        self.session = Session(session_id=session_id)
+        self.session = Session.get(session_id)
         self.page_route = None
-        self.task_manager = TaskManager(name=self.session.session_id, pool_size=5)
+        self.resume = None
+        self.task_manager = TaskManager(name=self.session.session_id, pool_size=options['pool_size'],
+            max_pending=options['task_queue'], overflow=options['task_overflow'])
+        self.session.attach(self.task_manager)
+        self._attached = True
 
     async def handle(self):
         websocket = self.websocket
@@ -145,12 +219,24 @@ class WaveClient:
             if req in [ClientRequest.invalid_request, ClientRequest.bad_request, None]:
                 continue
 
-            await self.process(req, websocket.url, websocket.headers)
+            shed = self.session.usage.message()
+            if shed == quota.REJECT:
+                continue
+            if shed == quota.DISCONNECT:
+                await self._close_sync_task()
+                await self.close()
+                return
+
+            self.inbound.submit(req)
 
-            if req.action == 'watch':
-                self.page_route = req.addr
-                await self.task_manager.spawn(self.start_sync_task())
+    async def handle_request(self, req):
+        await self.process(req, self.websocket.url, self.websocket.headers)
 
+        if req.action == 'watch':
+            self.page_route = req.addr
+            self.resume = req.resume()
+            # only starts the sync task, never queued behind the handler tasks of the pool.
+            await self.start_sync_task()
 
 
     async def _close_sync_task(self):
@@ -180,17 +266,63 @@ class WaveClient:
             await self.close()
             return
 
+    async def send_bytes(self, data):
+        try:
+            await self.websocket.send_bytes(data)
+        except WebSocketException:
+            await self.close()
+            return
+        except WebSocketDisconnect:
+            await self.close()
+            return
+
+    async def send_frame(self, frame):
+        if self.binary_frames:
+            await self.send_bytes(frame.payload)
+        else:
+            await self.send_text(frame.text)
+
+    async def send_frames(self, frames):
+        if len(frames) == 1:
+            await self.send_frame(frames[0])
+        elif self.binary_frames:
+            await self.send_bytes(b'\n'.join(f.payload for f in frames))
+        else:
+            # the browser client reads one message per line.
+            await self.send_text('\n'.join(f.text for f in frames))
+
+    async def _next_frames(self, sub):
+        frames = [await sub.changes()]
+        if self.flush_window <= 0:
+            return frames
+        if sub.pending() < self.max_batch - 1:
+            await asyncio.sleep(self.flush_window / 1000)
+        while len(frames) < self.max_batch and sub.pending():
+            frames.append(await sub.changes())
+        return frames
+
     async def page_sync(self):
         assert self.session != None
-        page = self.session.page(self.page_route)
-        page_data = await page.start_sync()
-        if page_data:
-            await self.send_text(json.dumps(page_data))
-
-        while not self.quit:
-            data = await page.changes()
-            await self.send_text(json.dumps(data))
-            page.send_done()
+        page = self.session.page(self.page_route, WaveApp.mode_of(self.page_route), self.user_info.user_id)
+        sub = page.subscribe(self.session.usage)
+        try:
+            frames = await sub.start_sync(resume=self.resume)
+            self.resume = None
+            if frames:
+                await self.send_frames(frames)
+
+            while not self.quit:
+                try:
+                    frames = await self._next_frames(sub)
+                except SlowConsumerError:
+                    logger.warning(f'disconnect slow client of {self.page_route}.')
+                    await self.close()
+                    return
+                await self.send_frames(frames)
+                for _ in frames:
+                    sub.send_done()
+        finally:
+            page.unsubscribe(sub)
 
 
     async def process(self, req, url, headers):
@@ -202,39 +334,59 @@ class WaveClient:
             route = req.addr,
             url = url,
             headers = headers,
-            args = Expando(args),
-            events = Expando(events_state),
-            task_manager = self.task_manager
+            args = args,
+            events = events_state,
+            task_manager = self.task_manager,
+            mode = WaveApp.mode_of(req.addr)
         )
+        # the handler, its `q.exec` calls and its background tasks share the handler's deadline.
+        token = set_deadline(self.handler_timeout) if self.handler_timeout else None
         # noinspection PyBroadException,PyPep8
         try:
             app = WaveApp.get(req.addr)
             await app.handle(req.addr, q)
+            # q.user may have changed.
+            self.session.changed()
         except NoHandlerException:
             await self.send_text('{"e":"not_found"}')
         except:
             logger.exception('Unhandled exception')
             # noinspection PyBroadException,PyPep8
             try:
-                q.page.drop()
                 # TODO replace this with a custom-designed error display
-                q.page['__unhandled_error__'] = markdown_card(
+                card = markdown_card(
                     box='1 1 12 10',
                     title='Error',
                     content=f'```\n{traceback.format_exc()}\n```',
                 )
-                await q.page.save()
+                if q.page is self.session.pages.get(req.addr):
+                    q.page.drop()
+                    q.page['__unhandled_error__'] = card
+                    await q.page.save()
+                else:
+                    # a shared page is watched by other clients too, only this one sees the error.
+                    page = PageBase(req.addr)
+                    page['__unhandled_error__'] = card
+                    await self.send_text(page._diff())
             except:
                 logger.exception('Failed transmitting unhandled exception')
+        finally:
+            if token is not None:
+                reset_deadline(token)
 
     async def close(self):
+        self.inbound.close()
+        if self._attached:
+            self._attached = False
+            self.session.detach(self.task_manager)
         try:
             self.quit = True
             await self.websocket.close()
         except Exception as ex:
             logger.debug(f'Exception when close, {ex}')
 
-        await self.task_manager.join(timeout=1)
+        # nobody is left to see the results of the client's tasks, nor of those its handlers still spawn.
+        await self.task_manager.close(DISCONNECT, timeout=1)
 
 class WaveApp:
     _apps = []
@@ -258,6 +410,16 @@ class WaveApp:
         return [Middleware(SessionMiddleware, **cls._session_config)]
 
 
+    @classmethod
+    def mode_of(cls, route) -> str:
+        """
+        The mode of the app serving `route`: `unicast` gives every session its own page, `multicast` shares
+        one page per user and `broadcast` one page per route between all clients. The user of a client is
+        taken from its connection, see `UserInfo.from_scope`, clients without one get a page of their session.
+        """
+        app = cls._app_routes.get(route, None)
+        return app._modes.get(route, UNICAST) if app is not None else UNICAST
+
     @classmethod
     def all(cls):
         return cls._apps
@@ -274,6 +436,7 @@ class WaveApp:
         self._base_url = ''
         self._route = None
         self._routes = {}
+        self._modes = {}
         self._static_dirs = {}
         self._handlers = {}
         self._startup = []
@@ -289,6 +452,7 @@ class WaveApp:
         if self._route == None:
             self._route = route
         self._routes[route] = handle
+        self._modes[route] = self.mode
         WaveApp.register(self)
 
     def setup_static(self, local_dir, name='static'):
@@ -325,6 +489,74 @@ class WaveApp:
         if secret_key:
             cls._session_config['secret_key'] = secret_key
 
+    @classmethod
+    def config_session_store(cls, on_evict=None, **kwargs):
+        """
+        Limit the sessions kept in memory with `ttl`, `max_sessions` and `max_bytes`, see `SessionRegistry`.
+        `on_evict(session, reason)` is called for every evicted session.
+        Pass a `store` from `wavegui.store` to keep sessions beyond the memory of this process,
+        and `store_ttl` to delete the sessions not written for that many seconds from it. `q.user` is stored
+        as JSON. Processes sharing a store must each serve their own sessions, as the workers of `run_workers` do.
+        """
+        Session.registry.configure(**kwargs)
+        if on_evict is not None:
+            Session.registry.on_evict(on_evict)
+
+    @classmethod
+    def config_quota(cls, **kwargs):
+        """
+        Limit the resources of every session, e.g. `page_bytes=(1 << 20, 4 << 20), message_rate=50`,
+        see `wavegui.quota.Quota`. Usage is available as `q.session.usage.report()`.
+        """
+        Session.quota = Quota(**kwargs)
+
+    @classmethod
+    def config_process_pool(cls, size=None, preload=(), **kwargs):
+        """
+        Set up the process pool of `q.run_cpu`, its `size` workers are started with the server and import
+        the `preload` modules, see `wavegui.task.ProcessPool`.
+        """
+        ProcessPool.default = ProcessPool(size=size, preload=preload, **kwargs)
+
+    @classmethod
+    def config_cache(cls, max_entries=1024, ttl=60):
+        """
+        Set up the server-wide cache of `q.cached_run` and `@cached` functions, see `wavegui.cache.ResultCache`.
+        """
+        ResultCache.default = ResultCache(max_entries=max_entries, ttl=ttl)
+
+    @classmethod
+    def config_timers(cls, tick=0.1, slots=512):
+        """
+        Set up the timer wheel of `q.every`, timers due within the same `tick` seconds run together,
+        see `wavegui.task.TimerWheel`.
+        """
+        TimerWheel.default = TimerWheel(tick=tick, slots=slots)
+
+    @classmethod
+    def config_scheduler(cls, max_running=None, weights=None):
+        """
+        Limit the background tasks running at once in the process, shared fairly between sessions,
+        `weights` gives some session ids a larger share. See `wavegui.task.Scheduler`.
+        """
+        TaskManager.scheduler.configure(max_running=max_running, weights=weights)
+
+    @classmethod
+    def config_client(cls, **kwargs):
+        """
+        Set the default websocket client options, e.g. `flush_window=20, max_batch=64` to batch patches.
+        `handler_timeout` gives every handler a deadline, which `q.exec` calls and `q.run_in_back` tasks
+        of the handler inherit; handlers check it with `q.remaining()`.
+        """
+        WaveClient._client_config.update(kwargs)
+
+    @classmethod
+    def config_page(cls, **kwargs):
+        """
+        Set the options used for every new page, e.g. `coalesce=True` to merge queued patches before sending.
+        """
+        Session.config_page(**kwargs)
+
     def run(self, on_startup=[], on_shutdown=[], no_reload=True, log_level="info", init_options=None, **kwargs):
         self._startup.extend(on_startup)
         self._shutdown.extend(on_shutdown)
@@ -424,7 +656,29 @@ class WaveServer:
         middleware = []
         middleware.extend(WaveApp.get_middlewares())
         self._server = Starlette(debug=True, routes=self._routes, middleware=middleware,
-            on_startup=self._startup, on_shutdown=self._shutdown)
+            on_startup=self._startup + [self.start_sessions, self.start_process_pool],
+            on_shutdown=self._shutdown + [self.stop_timers, self.close_sessions, self.stop_process_pool])
+
+    async def start_process_pool(self):
+        if ProcessPool.default is not None:
+            await ProcessPool.default.start()
+
+    def stop_process_pool(self):
+        if ProcessPool.default is not None:
+            ProcessPool.default.shutdown(wait=False)
+
+    def stop_timers(self):
+        if TimerWheel.default is not None:
+            TimerWheel.default.stop()
+
+    def start_sessions(self):
+        Session.registry.start()
+
+    async def close_sessions(self):
+        """
+        Write the sessions and pages changed since the last flush to the session store, if one is configured.
+        """
+        await Session.registry.close()
 
     def homepage(self, request):
         if 'session_id' not in request.session:
@@ -443,6 +697,9 @@ class WaveServer:
         return FileResponse(os.path.join(self._www_dir, name))
 
     async def handle_ws(self, websocket):
+        session_id = websocket.scope.get('session', {}).get('session_id', None)
+        if session_id is not None:
+            await Session.registry.preload(session_id)
         client = WaveClient(websocket)
         await client.handle()
 
@@ -481,6 +738,22 @@ class WaveServer:
         return await self._server(scope, receive, send)
 
     def run_forever(self, no_reload=True, log_level="info", **kwargs):
+        """
+        Serve the app. With `workers=N` above 1, N worker processes serve it behind a dispatcher
+        that keeps every session on one worker, see `wavegui.dispatch`. Multicast and broadcast pages
+        are shared in the memory of one process, apps with such routes are served by one worker.
+        """
         port = kwargs.get('port', 8000)
+        workers = kwargs.get('workers') or 1
         sys.path.insert(0, '.')
+        if workers > 1:
+            shared = [route for app in WaveApp.all() for route, mode in app._modes.items() if mode != UNICAST]
+            if shared:
+                # every worker would have its own copy of the shared pages.
+                raise ValueError(f'Routes {", ".join(shared)} are multicast or broadcast, they need workers=1.')
+            config = WaveApp._session_config
+            run_workers(self, workers, host='0.0.0.0', port=port, log_level=log_level,
+                        socket_dir=kwargs.get('socket_dir'), session_cookie=config['session_cookie'],
+                        secret_key=config['secret_key'], max_age=config['max_age'])
+            return
         uvicorn.run(self, host='0.0.0.0', port=port, reload=not no_reload, log_level=log_level)
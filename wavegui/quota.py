@@ -0,0 +1,184 @@
+"""
+Per-session resource accounting and limits.
+
+Every session has a `SessionUsage` that tracks the bytes of its pages, the bytes of patches queued for its
+clients, its running background tasks and the rate of messages from its clients. Limits are set for all
+sessions with `WaveApp.config_quota()`; without them usage is only accounted.
+"""
+import logging
+import time
+from typing import Optional, Tuple, Union
+
+from .exception import QuotaExceededError
+
+logger = logging.getLogger(__name__)
+
+PAGE_BYTES = 'page_bytes'
+QUEUED_BYTES = 'queued_bytes'
+TASKS = 'tasks'
+MESSAGE_RATE = 'message_rate'
+_resources = (PAGE_BYTES, QUEUED_BYTES, TASKS, MESSAGE_RATE)
+
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+
+Limit = Union[int, float, Tuple[float, float], None]
+
+
+def _limits(limit: Limit) -> Tuple[Optional[float], Optional[float]]:
+    if isinstance(limit, (tuple, list)):
+        return limit[0], limit[1]
+    return None, limit
+
+
+def _shrinks(ops: list) -> bool:
+    # drops and card deletes only free memory, ops before a drop do not count.
+    for i in range(len(ops) - 1, -1, -1):
+        if not ops[i].get('k'):
+            ops = ops[i + 1:]
+            break
+    return all(len(op) <= 1 for op in ops)
+
+
+class Quota:
+    """
+    Limits for every session. Each limit is a number, the hard limit, or a `(soft, hard)` tuple.
+    Crossing a soft limit is logged and counted. Crossing a hard limit sheds load.
+
+    Args:
+        page_bytes: Bytes of the session's pages. Above the hard limit saves raise `QuotaExceededError`,
+            except saves that only drop the page or delete cards.
+        queued_bytes: Bytes of patches queued for the session's clients. Above the hard limit, `on_queue_full`
+            decides: `drop_oldest` drops the queued patches and sends a snapshot, `disconnect` disconnects the client.
+        tasks: Background tasks of the session running at once, see `Query.run_in_back`.
+            New tasks raise `QuotaExceededError` above the hard limit.
+        message_rate: Messages per second from the session's clients. Above the hard limit, `on_flood`
+            decides: `reject` ignores the messages, `disconnect` disconnects the client.
+    """
+
+    def __init__(self, page_bytes: Limit = None, queued_bytes: Limit = None, tasks: Limit = None,
+                 message_rate: Limit = None, on_queue_full=DROP_OLDEST, on_flood=REJECT):
+        if on_queue_full not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f'Unknown queue action {on_queue_full}.')
+        if on_flood not in (REJECT, DISCONNECT):
+            raise ValueError(f'Unknown flood action {on_flood}.')
+        self.limits = {
+            PAGE_BYTES: _limits(page_bytes),
+            QUEUED_BYTES: _limits(queued_bytes),
+            TASKS: _limits(tasks),
+            MESSAGE_RATE: _limits(message_rate),
+        }
+        self.on_queue_full = on_queue_full
+        self.on_flood = on_flood
+
+
+class SessionUsage:
+    """
+    Resource usage of a session, checked against the `Quota` of its class.
+    `soft` and `hard` count how many times each limit was crossed.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.queued_bytes = 0
+        self.tasks = 0
+        self.messages = 0
+        self.soft = dict.fromkeys(_resources, 0)
+        self.hard = dict.fromkeys(_resources, 0)
+        self._window = 0
+        self._window_messages = 0
+        self._over = set()
+
+    @property
+    def quota(self) -> Optional[Quota]:
+        return self.session.quota
+
+    def page_bytes(self, exact=False) -> int:
+        """
+        Encoded size of the session's pages in memory, estimated from the last snapshots and the patches since.
+        """
+        if exact:
+            return sum(page.snapshot_size() for page in self.session.pages.values() if not page.hibernated)
+        return self.session.estimated_size()
+
+    def message_rate(self) -> int:
+        return self._window_messages if self._window == int(time.monotonic()) else 0
+
+    def report(self) -> dict:
+        return dict(page_bytes=self.page_bytes(), queued_bytes=self.queued_bytes, tasks=self.tasks,
+                    message_rate=self.message_rate(), messages=self.messages,
+                    soft=dict(self.soft), hard=dict(self.hard))
+
+    def _exceeds(self, resource, value) -> bool:
+        """
+        Count and log a crossed limit, True if the hard one is crossed.
+        """
+        soft, hard = self.quota.limits[resource]
+        if hard is not None and value > hard:
+            self.hard[resource] += 1
+            logger.warning(f'session {self.session.session_id} over its {resource} limit: {value} > {hard}.')
+            return True
+        if soft is not None and value > soft:
+            if resource not in self._over:
+                self._over.add(resource)
+                self.soft[resource] += 1
+                logger.info(f'session {self.session.session_id} over its soft {resource} limit: {value} > {soft}.')
+        else:
+            self._over.discard(resource)
+        return False
+
+    def check_save(self, ops: list):
+        """
+        Raise `QuotaExceededError` if the session's pages are over the hard limit and `ops` add to them.
+        """
+        if self.quota is None or not ops:
+            return
+        soft, hard = self.quota.limits[PAGE_BYTES]
+        if hard is None and soft is None:
+            return
+        size = self.page_bytes()
+        if hard is not None and size > hard:
+            # the estimate only grows between snapshots, measure before rejecting.
+            size = self.page_bytes(exact=True)
+        if self._exceeds(PAGE_BYTES, size) and not _shrinks(ops):
+            raise QuotaExceededError(f'session {self.session.session_id} is over its page bytes limit.')
+
+    def check_queue(self) -> Optional[str]:
+        """
+        The action to take for the queued patches, None if they are within the limits.
+        """
+        if self.quota is None:
+            return None
+        if self._exceeds(QUEUED_BYTES, self.queued_bytes):
+            return self.quota.on_queue_full
+        return None
+
+    def check_task(self):
+        if self.quota is not None and self._exceeds(TASKS, self.tasks + 1):
+            raise QuotaExceededError(f'session {self.session.session_id} runs too many background tasks.')
+
+    def start_task(self):
+        """
+        Count a background task of the session from its admission, until `task_done`.
+        Raises `QuotaExceededError` above the hard limit.
+        """
+        self.check_task()
+        self.tasks += 1
+
+    def task_done(self, *_):
+        self.tasks -= 1
+
+    def message(self) -> Optional[str]:
+        """
+        Count a message from a client, returns the action to take when over the rate limit, else None.
+        """
+        self.messages += 1
+        window = int(time.monotonic())
+        if window != self._window:
+            self._window = window
+            self._window_messages = 0
+        self._window_messages += 1
+        if self.quota is not None and self._exceeds(MESSAGE_RATE, self._window_messages):
+            return self.quota.on_flood
+        return None
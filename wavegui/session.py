@@ -1,108 +1,1041 @@
 
 import logging
-from typing import List, Dict, Union, Tuple, Any, Tuple, Callable, Awaitable, Optional
+from typing import List, Dict, Union, Tuple, Any, Callable, Optional
 import asyncio
 from concurrent.futures import Executor
-import string
 import random
 from datetime import datetime
-from .core import PageBase, Expando
-import json
+from collections import deque, OrderedDict
+import time
+import os
+import hashlib
+import tempfile
+from .core import PageBase, Expando, expando_to_dict, UNICAST, MULTICAST, BROADCAST
+from . import codec
+from .state import PageState, packer
+from .exception import SlowConsumerError, QuotaExceededError, DeadlineExceededError, TaskRejectedError
+from .quota import Quota, SessionUsage
+from .task import ProcessPool, TimerWheel, Timer, remaining, check_deadline, iscoroutine_or_partial, close_coroutine
+from .cache import default_cache
+from .store import SessionStore, SessionRecord, SHARED, pack_snapshot, unpack_snapshot
 
 try:
     import contextvars  # Python 3.7+ only.
 except ImportError:
     contextvars = None
 
-import logging
 import functools
+import inspect
 
 logger = logging.getLogger(__name__)
 
+_APPEND = '__append__'
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+CONFLATE = 'conflate'
+DISCONNECT = 'disconnect'
+_backpressure_policies = (BLOCK, DROP_OLDEST, CONFLATE, DISCONNECT)
+
+def _is_covered(key, covered):
+    parts = key.split(' ')
+    for i in range(1, len(parts) + 1):
+        if ' '.join(parts[:i]) in covered:
+            return True
+    return False
+
+def coalesce_patches(patches):
+    """
+    Merge patches into a single patch, in order.
+    An op is dropped when a later op writes the same card key or Ref path (or one of its parents),
+    `__append__` ops are kept since they accumulate, and a page drop discards everything before it.
+    """
+    ops = []
+    for p in patches:
+        ops.extend(p.ops)
+    kept = []
+    covered = set()
+    for op in reversed(ops):
+        key = op.get('k')
+        if not key:
+            kept.append(op)
+            break
+        if _is_covered(key, covered):
+            continue
+        kept.append(op)
+        if not key.endswith(' ' + _APPEND):
+            covered.add(key)
+    kept.reverse()
+    return Patch(kept, patches[-1].seq)
+
+class Frame:
+    """
+    A message for the browser, encoded once when it is created.
+    `payload` is the UTF-8 JSON, `text` is decoded from it on first use; both are shared by every consumer.
+    """
+    __slots__ = ('payload', '_text')
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.payload.decode('utf-8')
+        return self._text
+
+class Patch(Frame):
+    """
+    A `{"d": [...], "s": seq}` frame, keeping its ops for coalescing.
+    `seq` is the page sequence number after the patch, the browser client ignores it.
+    """
+    __slots__ = ('ops', 'seq')
+
+    def __init__(self, ops: list, seq: int = 0):
+        self.ops = ops
+        self.seq = seq
+        super().__init__(codec.dumpb({'d': ops, 's': seq}))
+
+class PageSubscription:
+    """
+    The queue of patches for one client watching a page, with the page's backpressure policy applied to it.
+    """
+    def __init__(self, page: 'AsyncPage', usage: Optional[SessionUsage] = None):
+        self.page = page
+        self.usage = usage
+        self.queued_bytes = 0
+        self._queue = asyncio.Queue(maxsize=page.queue_size)
+        self._synced_seq = 0
+        self._resync = False
+        self._slow_consumer = False
+
+    def _count(self, patch, sign):
+        n = sign * len(patch.payload)
+        self.queued_bytes += n
+        if self.usage is not None:
+            self.usage.queued_bytes += n
+
+    def _push(self, patch):
+        self._queue.put_nowait(patch)
+        self._count(patch, 1)
+
+    def _taken(self, patch):
+        self._count(patch, -1)
+        return patch
+
+    def _discard(self, n):
+        patches = []
+        for _ in range(n):
+            patches.append(self._taken(self._queue.get_nowait()))
+            self._queue.task_done()
+        return patches
+
+    async def put(self, patch: Patch):
+        queue = self._queue
+        if not queue.full():
+            self._push(patch)
+        else:
+            await self._put_full(patch)
+        if self.usage is not None and self.queued_bytes:
+            self._shed(self.usage.check_queue())
+
+    def _shed(self, action):
+        if action == DROP_OLDEST:
+            # keep the newest patch, it wakes the client up to send a snapshot instead.
+            self._discard(self._queue.qsize() - 1)
+            self._resync = True
+        elif action == DISCONNECT:
+            self._slow_consumer = True
+
+    async def _put_full(self, patch: Patch):
+        queue = self._queue
+        page = self.page
+        stats = page.backpressure_stats
+        if page.backpressure == DROP_OLDEST:
+            stats['dropped'] += 1
+            self._discard(1)
+            self._resync = True
+            self._push(patch)
+        elif page.backpressure == CONFLATE:
+            stats['conflated'] += 1
+            patches = self._discard(queue.qsize())
+            patches.append(patch)
+            self._push(coalesce_patches(patches))
+        elif page.backpressure == DISCONNECT:
+            stats['disconnected'] += 1
+            self._discard(queue.qsize())
+            self._slow_consumer = True
+        else:
+            stats['blocked'] += 1
+            try:
+                await asyncio.wait_for(queue.put(patch), page.block_timeout)
+                self._count(patch, 1)
+            except asyncio.TimeoutError:
+                stats['timeout'] += 1
+                self._resync = True
+                logger.warning(f'page {page.url} queue full for {page.block_timeout}s, patch dropped.')
+
+    async def start_sync(self, resume: Optional[Tuple[int, Optional[str]]] = None) -> List[Frame]:
+        """
+        Frames that bring the client up to date: the patches after the `(seq, epoch)` of `resume` if the page
+        has the same epoch and the ring still has them, else the page snapshot.
+        Queued patches already covered are skipped by `changes()`.
+        """
+        page = self.page
+        async with page._lock:
+            self._synced_seq = page.seq
+            if resume is not None:
+                patches = page._replay(*resume)
+                if patches is not None:
+                    return patches
+            return [page._snapshot_frame()]
+
+    async def changes(self) -> Frame:
+        while True:
+            if self._slow_consumer:
+                self._slow_consumer = False
+                self._discard(self._queue.qsize())
+                raise SlowConsumerError(f'client of page {self.page.url} is too slow.')
+            patch = self._taken(await self._queue.get())
+            # self._queue.task_done()
+            if self._slow_consumer:
+                self._queue.task_done()
+                continue
+            if self._resync:
+                # patches were lost, the queued ones are covered by the snapshot.
+                self._resync = False
+                self._discard(self._queue.qsize())
+                async with self.page._lock:
+                    self._synced_seq = self.page.seq
+                    return self.page._snapshot_frame()
+            if patch.ops and patch.seq <= self._synced_seq:
+                self._queue.task_done()
+                continue
+            break
+        if self.page.coalesce and not self._queue.empty():
+            patches = [patch]
+            patches.extend(self._discard(self._queue.qsize()))
+            patch = coalesce_patches(patches)
+        return patch
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def send_done(self):
+        self._queue.task_done()
+
 class AsyncPage(PageBase):
-    def __init__(self, url: str):
-        self._queue = asyncio.Queue(maxsize=1000)
+    """
+    A page kept in server memory. Every client watching it gets its own `PageSubscription`.
+
+    Args:
+        url: The route of the page.
+        coalesce: Merge all queued patches into one when a client dequeues them.
+        queue_size: Maximum number of patches queued for a client.
+        backpressure: What a save does when a client queue is full. `block` waits up to `block_timeout` seconds,
+            `drop_oldest` drops the oldest patch, `conflate` merges the queue into one patch,
+            `disconnect` drops the queue and disconnects the client. The client gets a full snapshot
+            instead of the patches it missed.
+        block_timeout: Seconds to wait with the `block` policy, None to wait forever.
+        ring_size: Number of recent patches kept to let a reconnecting client resume, 0, the default, to always
+            send a snapshot. The bundled browser client never resumes, the ring is for clients that do.
+        diff: Send only the changed parts of a card assigned again under the same key, see `PageBase.diff_cards`.
+        compact: Keep the cards of a page whose last watcher left as encoded bytes, `raw`, `zlib` or `zstd`
+            compressed. They are inflated when a client watches the page again, or one by one when a save changes
+            part of a card.
+
+    Every patch that changes the page gets the next sequence number, sent as `s` with the patch and the snapshot.
+    The snapshot also carries the page's epoch `e`, a random id of this page history: a page created again,
+    e.g. after a restart without a store or an eviction, starts a new history from 0 with a new epoch.
+    A client that watches with `{"s": seq, "e": epoch}` only gets the patches it missed, when the epoch matches
+    and they are still in the ring, else the snapshot.
+    Saves to a page nobody watches only update its state.
+
+    A page nobody watches can be hibernated: its state is written to a spill file and dropped from memory,
+    it is loaded back when a client watches it, it is saved or its data is read.
+    """
+    def __init__(self, url: str, **kwargs):
+        self.backpressure = kwargs.get('backpressure') or BLOCK
+        if self.backpressure not in _backpressure_policies:
+            raise ValueError(f'Unknown backpressure policy {self.backpressure}.')
+        self.block_timeout = kwargs.get('block_timeout', 5)
+        self.queue_size = kwargs.get('queue_size') or 1000
         self._lock = asyncio.Lock()
-        self.data = {}
+        self._state = PageState()
+        self.seq = 0
+        self.epoch = os.urandom(6).hex()
+        self._ring = deque(maxlen=kwargs.get('ring_size', 0))
+        self.coalesce = kwargs.get('coalesce', False)
+        self.diff_cards = kwargs.get('diff', False)
+        self.compact = kwargs.get('compact')
+        self._packer = packer(self.compact) if self.compact else None
+        self._idle = False
+        self.idle_since = time.monotonic()
+        self._spill = None
+        self.backpressure_stats = dict(blocked=0, timeout=0, dropped=0, conflated=0, disconnected=0)
+        self.subscriptions = []
+        self.on_change = None
+        self.guard = None
+        self._size = 0
+        self._snapshot = None
         super().__init__(url)
 
+    @property
+    def data(self) -> dict:
+        """
+        The current cards of the page, with every saved op applied.
+        """
+        self._wake()
+        return self._state.all_cards()
+
     def keys(self):
         return self.data.keys()
 
+    @property
+    def watched(self) -> bool:
+        return len(self.subscriptions) > 0
+
+    def subscribe(self, usage: Optional[SessionUsage] = None) -> PageSubscription:
+        """
+        Start queueing patches for a client, counted in the `usage` of its session.
+        """
+        sub = PageSubscription(self, usage)
+        self.subscriptions.append(sub)
+        self._wake()
+        if self._idle:
+            self._idle = False
+            self._state.inflate()
+        return sub
+
+    def unsubscribe(self, sub: PageSubscription):
+        if sub in self.subscriptions:
+            self.subscriptions.remove(sub)
+        if not self.subscriptions:
+            self.idle_since = time.monotonic()
+            if self._packer is not None:
+                self._idle = True
+                self._compact()
+
+    def _compact(self):
+        self._state.compact(*self._packer)
+        self._snapshot = None
+        # the previous cards kept to diff against are as large as the page.
+        self._cards.clear()
+        # a compacted page keeps no history, reconnecting clients get a snapshot.
+        self._ring.clear()
+
     def _get_diff(self):
         if len(self._changes) == 0:
             return None
-        d = dict(d=self._changes)
+        d = self._changes
         self._changes = []
         return d
 
     async def save(self):
         """
+        Save the page. Local changes are encoded once here and queued for every watching client.
         """
-        p = self._get_diff()
-        if p:
-            logger.debug(p)
-            await self._patch(p)
+        ops = self._get_diff()
+        if ops:
+            logger.debug(ops)
+            if self.guard is not None:
+                try:
+                    self.guard(ops)
+                except QuotaExceededError:
+                    # keep the changes, a later save may send them.
+                    self._changes[:0] = ops
+                    raise
+            await self._patch(ops)
         else:
-            await self._patch({"d":[]})
-
-    def _make_card(self, data, buf):
-        return {'d':data}
+            await self._patch([])
 
-    async def _patch(self, ops):
+    async def _patch(self, ops: list):
         async with self._lock:
-            for op in ops.get('d', []):
-                if 'k' in op:
-                    if len(op['k']) > 0 and 'd' in op:
-                        self.data[op['k']] = self._make_card(op['d'], op.get('b', []))
-                else:
-                    self.data = {}
-        await self._queue.put(ops)
-
-    async def start_sync(self):
-        async with self._lock:
-            page_data = self.data;
-            return {'p':{'c':page_data}}
+            self._wake()
+            if not self.subscriptions:
+                self.idle_since = time.monotonic()
+            self._state.apply(ops)
+            if self._idle and ops:
+                self._compact()
+            if ops:
+                self.seq += 1
+                self._snapshot = None
+                if self.on_change is not None:
+                    self.on_change()
+            patch = Patch(ops, self.seq)
+            if ops:
+                self._size += len(patch.payload)
+            if ops and self._ring.maxlen and not self._idle:
+                self._ring.append(patch)
+        blocked = []
+        for sub in list(self.subscriptions):
+            if self.backpressure == BLOCK and sub._queue.full():
+                # waits for a slow client must not delay the other clients of the page.
+                blocked.append(sub.put(patch))
+            else:
+                await sub.put(patch)
+        if blocked:
+            await asyncio.gather(*blocked)
 
-    async def changes(self):
-        data = await self._queue.get()
-        # self._queue.task_done()
-        return data
+    def _snapshot_frame(self) -> Frame:
+        if self._snapshot is None:
+            frame = Frame(codec.dumpb({'p':{'c':self.data}, 's':self.seq, 'e':self.epoch}))
+            self._size = len(frame.payload)
+            if self._idle:
+                # not kept, it would hold the whole page again.
+                return frame
+            self._snapshot = frame
+        return self._snapshot
 
-    def send_done(self):
-        self._queue.task_done()
+    def load_snapshot(self, payload: bytes):
+        """
+        Restore the cards and sequence number of the page from an encoded snapshot, see `snapshot()`.
+        """
+        msg = codec.loads(payload)
+        self._state = PageState()
+        self._state.cards = msg['p']['c']
+        self.seq = msg.get('s', 0)
+        # the history goes on from the stored snapshot, clients of it can resume.
+        self.epoch = msg.get('e') or os.urandom(6).hex()
+        self._ring.clear()
+        self._snapshot = Frame(payload)
+        self._size = len(payload)
+
+    def snapshot(self) -> bytes:
+        """
+        The page encoded as the `{"p": {"c": cards}, "s": seq, "e": epoch}` message a client gets when it starts watching.
+        """
+        if self._spill is not None:
+            with open(self._spill, 'rb') as f:
+                return unpack_snapshot(f.read())
+        return self._snapshot_frame().payload
+
+    @property
+    def hibernated(self) -> bool:
+        return self._spill is not None
+
+    def idle_time(self) -> float:
+        """
+        Seconds since the page was last saved or watched, 0 while it is watched.
+        """
+        return 0 if self.subscriptions else time.monotonic() - self.idle_since
+
+    def hibernate(self, path: str) -> bool:
+        """
+        Write the page to the spill file `path` and drop its state from memory, unless it is watched.
+        """
+        if self.subscriptions or self._spill is not None:
+            return False
+        payload = self.snapshot()
+        with open(path, 'wb') as f:
+            f.write(pack_snapshot(payload))
+        self._state = PageState()
+        self._ring.clear()
+        self._snapshot = None
+        self._size = 0
+        self._spill = path
+        return True
+
+    def _wake(self):
+        if self._spill is None:
+            return
+        path = self._spill
+        payload = self.snapshot()
+        self._spill = None
+        self.load_snapshot(payload)
+        self.discard_spill(path)
+        if self._idle:
+            # still nobody watches it, e.g. woken by a read of its data.
+            self._compact()
+
+    def discard_spill(self, path=None):
+        path = path or self._spill
+        self._spill = None
+        if path is not None:
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning(f'failed to remove spill file {path}.')
+
+    def _replay(self, seq: int, epoch: Optional[str]) -> Optional[List[Patch]]:
+        if epoch != self.epoch:
+            # the client saw another history of the page.
+            return None
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self._ring or seq < self._ring[0].seq - 1:
+            return None
+        return [p for p in self._ring if p.seq > seq]
+
+    def estimated_size(self) -> int:
+        """
+        Approximate bytes of the page: the size of its last snapshot plus the patches since, cheaper than `memory_size()`.
+        """
+        return self._size
+
+    def snapshot_size(self) -> int:
+        """
+        Bytes of the encoded snapshot. Measuring does not keep the snapshot, unlike `snapshot()`.
+        """
+        if self._spill is not None:
+            return len(self.snapshot())
+        if self._snapshot is not None:
+            return len(self._snapshot.payload)
+        self._size = len(codec.dumpb({'p':{'c':self.data}, 's':self.seq, 'e':self.epoch}))
+        return self._size
+
+    def memory_size(self) -> int:
+        """
+        Approximate bytes held by the page: its encoded snapshot, or its compacted cards, and the patch ring.
+        """
+        if self._spill is not None:
+            return 0
+        ring = sum(len(p.payload) for p in self._ring)
+        if self._idle:
+            held = len(codec.dumpb(self._state.cards)) if self._state.cards else 0
+            return self._state.packed_size() + held + ring
+        return self.snapshot_size() + ring
+
+class SessionRegistry:
+    """
+    Sessions by id, kept in least recently used order and evicted when idle or over budget.
+    Sessions with a connected client are never evicted.
+
+    Args:
+        ttl: Seconds a session without clients is kept, None to keep it forever.
+        max_sessions: Maximum number of sessions, the least recently used idle ones are evicted first.
+        max_bytes: Budget for the page memory of all sessions, see `Session.memory_size`.
+        prune_interval: Seconds between two automatic prunes, see `start`.
+        store: A `SessionStore` backing the registry. Sessions not in memory are loaded from it, off the event
+            loop by `preload` when a client connects, changed sessions are written to it in batches, at most `flush_interval` seconds after the change,
+            and `close()` writes what is left and closes the store on shutdown. Evicted sessions stay in the store.
+        flush_interval: Seconds changes are collected before they are written to the store.
+        store_ttl: Seconds a session is kept in the store after it was last written, None to keep it forever.
+            Expired sessions are deleted by the periodic prune; sessions still in memory are written again when
+            they are evicted.
+        hibernate_after: Seconds after which a page nobody watches or saves is spilled to disk, None to keep
+            every page in memory, see `AsyncPage.hibernate`.
+        spill_dir: Directory of the spill files, a new temporary directory if not provided.
+    """
+    TTL = 'ttl'
+    LRU = 'lru'
+    BYTES = 'bytes'
+
+    def __init__(self, ttl=7200, max_sessions=None, max_bytes=None, prune_interval=10,
+                 store: Optional[SessionStore] = None, flush_interval=1, hibernate_after=None, spill_dir=None,
+                 store_ttl=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self.store = store
+        self.flush_interval = flush_interval
+        self.store_ttl = store_ttl
+        self.hibernate_after = hibernate_after
+        self.spill_dir = spill_dir
+        self.stats = dict(created=0, evicted=0, loaded=0, flushed=0, hibernated=0, expired=0)
+        self._sessions = OrderedDict()
+        self._evict_hooks = []
+        self._last_prune = time.monotonic()
+        self._dirty = set()
+        self._unflushed = {}
+        self._flush_handle = None
+        self._flush_task = None
+        self._prune_task = None
+        self.shared = SharedPages(self)
+
+    def configure(self, **kwargs):
+        for key in ('ttl', 'max_sessions', 'max_bytes', 'prune_interval', 'store', 'flush_interval',
+                    'hibernate_after', 'spill_dir', 'store_ttl'):
+            if key in kwargs:
+                setattr(self, key, kwargs[key])
+
+    def on_evict(self, hook: Callable[['Session', str], Any]):
+        """
+        Call `hook(session, reason)` when a session is evicted, reason is one of 'ttl', 'lru' or 'bytes'.
+        """
+        self._evict_hooks.append(hook)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id, create=True) -> Optional['Session']:
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._load(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = Session(session_id)
+                self.stats['created'] += 1
+            self._add(session_id, session)
+        else:
+            self._sessions.move_to_end(session_id)
+        session.touch()
+        if (self.max_sessions and len(self._sessions) > self.max_sessions) or \
+                time.monotonic() - self._last_prune >= self.prune_interval:
+            # the caller has not attached to the session yet, it must not be evicted.
+            self.prune(keep=session_id)
+        return session
+
+    async def preload(self, session_id):
+        """
+        Load a session from the store off the event loop, so the next `get` finds it in memory.
+        Called by the server before a client attaches to its session.
+        """
+        if self.store is None or session_id in self._sessions or session_id in self._unflushed:
+            return
+        try:
+            record = await asyncio.get_event_loop().run_in_executor(None, self.store.load, session_id)
+        except Exception:
+            logger.exception(f'failed to load session {session_id}')
+            return
+        # a `get` or an eviction while loading has a newer session.
+        if record is None or session_id in self._sessions or session_id in self._unflushed:
+            return
+        self._add(session_id, self._restore(session_id, record))
+
+    def load_record(self, session_id) -> Optional[SessionRecord]:
+        record = self._unflushed.get(session_id)
+        if record is None and self.store is not None:
+            # blocks the loop for a row lookup, only when the session was not preloaded, and for the
+            # `SHARED` record once per process.
+            try:
+                record = self.store.load(session_id)
+            except Exception:
+                logger.exception(f'failed to load session {session_id}')
+        return record
+
+    def _load(self, session_id) -> Optional['Session']:
+        record = self.load_record(session_id)
+        if record is None:
+            return None
+        return self._restore(session_id, record)
+
+    def _restore(self, session_id, record: SessionRecord) -> 'Session':
+        self.stats['loaded'] += 1
+        return Session.from_record(session_id, record)
+
+    def _add(self, session_id, session: 'Session'):
+        session.registry = self
+        self._sessions[session_id] = session
+
+    def changed(self, session: 'Session'):
+        """
+        Mark a session to be written to the store with the next flush.
+        """
+        if self.store is None:
+            return
+        self._dirty.add(session.session_id)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self.flush())
+        else:
+            # a flush is still writing, try again later.
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _collect(self):
+        for session_id in self._dirty:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._unflushed[session_id] = session.to_record()
+            elif session_id == SHARED:
+                self._unflushed[SHARED] = self.shared.to_record()
+        self._dirty.clear()
+        records = self._unflushed
+        self._unflushed = {}
+        return records
+
+    async def flush(self):
+        """
+        Write the changed sessions to the store in one batch, off the event loop.
+        """
+        if self.store is None:
+            return
+        records = self._collect()
+        if not records:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.store.save, records)
+            self.stats['flushed'] += len(records)
+        except Exception:
+            logger.exception('failed to write sessions to the store')
+            # keep them for the next flush, newer records win.
+            records.update(self._unflushed)
+            self._unflushed = records
+
+    def start(self):
+        """
+        Prune every `prune_interval` seconds, also while no new client connects. Started with the server.
+        """
+        if self._prune_task is None:
+            self._prune_task = asyncio.ensure_future(self._prune_forever())
+
+    async def _prune_forever(self):
+        while True:
+            await asyncio.sleep(self.prune_interval)
+            try:
+                self.prune()
+            except Exception:
+                logger.exception('failed to prune sessions')
+            await self.expire()
+
+    async def expire(self):
+        """
+        Delete the sessions not written for `store_ttl` seconds from the store, off the event loop.
+        """
+        if self.store is None or self.store_ttl is None:
+            return
+        try:
+            n = await asyncio.get_event_loop().run_in_executor(None, self.store.expire, self.store_ttl)
+            self.stats['expired'] += n
+        except Exception:
+            logger.exception('failed to expire sessions in the store')
+
+    async def close(self):
+        """
+        Write every change not written yet, to be called when the server shuts down.
+        """
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+            self._prune_task = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+        if self.store is not None:
+            self.store.close()
+
+    def evict(self, session_id, reason='manual'):
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return
+        if session_id in self._dirty or (self.store is not None and self.store_ttl is not None):
+            # written by the next flush, and reloaded from here until then. With `store_ttl` the stored
+            # record may have expired while the session was in memory.
+            self._dirty.discard(session_id)
+            self._unflushed[session_id] = session.to_record()
+            self._schedule_flush()
+        self.stats['evicted'] += 1
+        self.stats[reason] = self.stats.get(reason, 0) + 1
+        for hook in self._evict_hooks:
+            try:
+                hook(session, reason)
+            except Exception:
+                logger.exception('Session evict hook failed')
+        session.close()
+
+    def memory_size(self) -> int:
+        return sum(s.memory_size() for s in self._sessions.values())
+
+    def _idle(self, keep=None):
+        return [s for s in self._sessions.values() if s.clients == 0 and s.session_id != keep]
+
+    def _spill_path(self, *key) -> str:
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='wavegui-spill-')
+        name = hashlib.sha1(codec.dumpb(key)).hexdigest()
+        return os.path.join(self.spill_dir, name + '.page')
+
+    def hibernate(self):
+        """
+        Spill the pages not watched nor saved for `hibernate_after` seconds.
+        """
+        pages = [((s.session_id, route), page) for s in self._sessions.values() for route, page in s.pages.items()]
+        pages.extend(((SHARED,) + key, page) for key, page in self.shared.pages.items())
+        for key, page in pages:
+            if not page.hibernated and not page.watched and page.idle_time() > self.hibernate_after:
+                try:
+                    if page.hibernate(self._spill_path(*key)):
+                        self.stats['hibernated'] += 1
+                except OSError:
+                    logger.exception(f'failed to hibernate page {page.url}')
+
+    def prune(self, keep=None):
+        """
+        Evict expired sessions, hibernate idle pages, then evict the least recently used idle sessions
+        while over `max_sessions` or `max_bytes`. The session with id `keep` is never evicted.
+        """
+        self._last_prune = time.monotonic()
+        if self.ttl is not None:
+            for session in self._idle(keep):
+                if session.idle_time() > self.ttl:
+                    self.evict(session.session_id, self.TTL)
+        if self.hibernate_after is not None:
+            self.hibernate()
+        if self.max_sessions:
+            for session in self._idle(keep):
+                if len(self._sessions) <= self.max_sessions:
+                    break
+                self.evict(session.session_id, self.LRU)
+        if self.max_bytes:
+            total = self.memory_size()
+            for session in self._idle(keep):
+                if total <= self.max_bytes:
+                    break
+                total -= session.memory_size()
+                self.evict(session.session_id, self.BYTES)
+
+class _StoredPages:
+    """
+    Pages restored from a `SessionRecord` when first used. Keeps the packed snapshot of every page,
+    so unchanged pages are not packed again and pages never used are written back as they were loaded.
+    """
+    def __init__(self):
+        self._packed = {}
+
+    def load(self, record: SessionRecord):
+        self._packed = {key: (None, data) for key, data in record.pages.items()}
+
+    def restore(self, key, page: 'AsyncPage'):
+        stored = self._packed.get(key)
+        if stored is not None:
+            page.load_snapshot(unpack_snapshot(stored[1]))
+            self._packed[key] = (page.seq, stored[1])
+
+    def pack(self, pages: dict) -> dict:
+        for key, page in pages.items():
+            stored = self._packed.get(key)
+            if stored is None or stored[0] != page.seq:
+                self._packed[key] = (page.seq, pack_snapshot(page.snapshot()))
+        return {key: data for key, (_, data) in self._packed.items()}
+
+    def memory_size(self) -> int:
+        return sum(len(data) for _, data in self._packed.values())
+
+# the user id of clients that are not signed in.
+ANONYMOUS_USER_ID = 'WAVE_USER_ID'
+
+
+class SharedPages:
+    """
+    Pages shared by many sessions: one per route for broadcast apps, one per user and route for multicast apps.
+    A save is encoded once and queued for every client watching the page. Their backpressure defaults to
+    `conflate`, so a slow client does not hold back the saves seen by the others.
+    The pages are stored with the sessions of their registry, as the `SHARED` record.
+    They live in the memory of one process, the server refuses to serve them with several workers.
+    """
+    def __init__(self, registry: 'SessionRegistry' = None):
+        self.registry = registry
+        self.pages = {}
+        self._stored = None
+
+    def __len__(self):
+        return len(self.pages)
+
+    def page(self, key: tuple, route: str, **kwargs) -> 'AsyncPage':
+        page = self.pages.get(key)
+        if page is None:
+            kwargs.setdefault('backpressure', CONFLATE)
+            page = self.pages[key] = AsyncPage(route, **kwargs)
+            if self.registry is not None:
+                self._stored_pages().restore(codec.dumps(key), page)
+                page.on_change = self.changed
+        return page
+
+    def _stored_pages(self) -> _StoredPages:
+        if self._stored is None:
+            self._stored = _StoredPages()
+            record = self.registry.load_record(SHARED)
+            if record is not None:
+                self._stored.load(record)
+        return self._stored
+
+    def changed(self):
+        if self.registry.store is not None:
+            self.registry._dirty.add(SHARED)
+            self.registry._schedule_flush()
+
+    def to_record(self) -> SessionRecord:
+        pages = {codec.dumps(key): page for key, page in self.pages.items()}
+        return SessionRecord(None, self._stored_pages().pack(pages))
+
+    def memory_size(self) -> int:
+        return sum(page.memory_size() for page in self.pages.values())
 
 class Session:
-    _stores = {}
+    registry = SessionRegistry()
+    quota: Optional[Quota] = None
+    _page_options = {}
+
+    @classmethod
+    def config_page(cls, **kwargs):
+        cls._page_options.update(kwargs)
+
     @classmethod
     def get(cls, session_id):
-        if session_id not in cls._stores:
-            store = cls(session_id)
-            cls._stores[session_id] = store
-        return cls._stores[session_id]
+        return cls.registry.get(session_id)
 
     def __init__(self, session_id):
         self.session_id = session_id
         self.session_start = datetime.now()
         self.pages = {}
         self.user_data = Expando()
+        self.clients = 0
+        self.last_access = time.monotonic()
+        self.usage = SessionUsage(self)
+        self._stored = _StoredPages()
+        # the `q.every` timers of the session, cancelled with it.
+        self.timers = set()
+        self._task_managers = []
+
+    @property
+    def shared(self) -> SharedPages:
+        return self.registry.shared
 
-    def page(self, route):
+    def page(self, route, mode=UNICAST, user_id=None):
+        """
+        The page of a route, owned by this session for unicast apps, shared for multicast and broadcast apps.
+        Multicast pages are shared by the sessions of a signed-in user, without one they belong to the session.
+        """
+        if mode == BROADCAST:
+            return self.shared.page((BROADCAST, route), route, **self._page_options)
+        if mode == MULTICAST and user_id is not None and user_id != ANONYMOUS_USER_ID:
+            return self.shared.page((MULTICAST, user_id, route), route, **self._page_options)
         if route not in self.pages:
-            self.pages[route] = AsyncPage(route)
+            page = AsyncPage(route, **self._page_options)
+            self._stored.restore(route, page)
+            page.on_change = self.changed
+            page.guard = self.usage.check_save
+            self.pages[route] = page
         return self.pages[route]
 
+    def changed(self):
+        """
+        Mark the session to be written back to the session store, if one is configured.
+        """
+        self.registry.changed(self)
+
+    def to_record(self) -> SessionRecord:
+        # stored as JSON, never pickled: unpickling a record of a shared store could run any code.
+        try:
+            user = codec.dumpb(expando_to_dict(self.user_data))
+        except Exception:
+            logger.warning(f'q.user of session {self.session_id} holds values that are not JSON, it is not stored.')
+            user = None
+        meta = dict(start=self.session_start.timestamp())
+        return SessionRecord(user, self._stored.pack(self.pages), meta)
+
+    @classmethod
+    def from_record(cls, session_id, record: SessionRecord) -> 'Session':
+        """
+        A session restored from the store. Its pages are restored when they are first used.
+        """
+        session = cls(session_id)
+        if 'start' in record.meta:
+            session.session_start = datetime.fromtimestamp(record.meta['start'])
+        if record.user is not None:
+            try:
+                user = codec.loads(record.user)
+                if not isinstance(user, dict):
+                    raise ValueError(f'expected an object, got {type(user).__name__}')
+                session.user_data = Expando(user)
+            except Exception:
+                logger.exception(f'failed to decode q.user of session {session_id}')
+        session._stored.load(record)
+        return session
+
     @property
     def user(self):
         return self.user_data
 
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    def idle_time(self) -> float:
+        return time.monotonic() - self.last_access
+
+    def attach(self, task_manager=None):
+        """
+        Count a connected client, with the `TaskManager` running its tasks.
+        """
+        self.clients += 1
+        if task_manager is not None:
+            self._task_managers.append(task_manager)
+        self.touch()
+
+    def detach(self, task_manager=None):
+        self.clients = max(0, self.clients - 1)
+        if task_manager in self._task_managers:
+            self._task_managers.remove(task_manager)
+        self.touch()
+
+    @property
+    def task_manager(self):
+        """
+        The `TaskManager` of the most recently connected client, None without clients.
+        """
+        return self._task_managers[-1] if self._task_managers else None
+
+    def memory_size(self) -> int:
+        return sum(page.memory_size() for page in self.pages.values()) + self._stored.memory_size()
+
+    def estimated_size(self) -> int:
+        return sum(page.estimated_size() for page in self.pages.values())
+
+    def close(self):
+        for timer in list(self.timers):
+            timer.cancel()
+        for page in self.pages.values():
+            page.discard_spill()
+        self.pages = {}
+
 class UserInfo:
     def __init__(self, user_id=None, user_name=None):
-        self.user_id = user_id or 'WAVE_USER_ID'
+        self.user_id = user_id or ANONYMOUS_USER_ID
         self.user_name = user_name or 'anon'
 
+    @classmethod
+    def from_scope(cls, scope: dict) -> 'UserInfo':
+        """
+        The user of a connection: the authenticated `scope['user']` of starlette's `AuthenticationMiddleware`,
+        else the `user_id` and `user_name` a login handler stored in the session cookie, else anonymous.
+        """
+        user = scope.get('user')
+        if user is not None and getattr(user, 'is_authenticated', False):
+            try:
+                user_id = user.identity
+            except NotImplementedError:
+                user_id = user.display_name
+            return cls(user_id, user.display_name)
+        session = scope.get('session') or {}
+        return cls(session.get('user_id'), session.get('user_name'))
+
     def anonymouse(self):
-        return self.user_id == 'WAVE_USER_ID'
+        return self.user_id == ANONYMOUS_USER_ID
+
+
+async def _call_async(func, *args):
+    ret = func(*args)
+    if inspect.isawaitable(ret):
+        ret = await ret
+    return ret
+
+
+async def _within_deadline(aw):
+    left = remaining()
+    if left is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, left)
+    except asyncio.TimeoutError as ex:
+        if isinstance(ex, DeadlineExceededError) or remaining():
+            raise
+        raise DeadlineExceededError('deadline exceeded.') from None
 
 
 class Query:
@@ -112,6 +1045,8 @@ class Query:
     arrives from the browser (page load, user interaction events, etc.).
     """
 
+    __slots__ = ('mode', 'user_info', 'route', 'url', 'headers', 'session', 'task_manager', '_page', '_args', '_events')
+
     def __init__(
             self,
             user_info: UserInfo,
@@ -119,21 +1054,44 @@ class Query:
             route: str,
             url: str,
             headers: dict,
-            args: Expando,
-            events: Expando,
-            task_manager
+            args: Union[Expando, dict, None],
+            events: Union[Expando, dict, None],
+            task_manager,
+            mode: str = UNICAST
     ):
-        self.mode = "unicast"
-        self.page = session.page(route)
-        self.args = args
-        self.events = events
+        self.mode = mode
         self.user_info = user_info
         self.route = route
         self.url = url
         self.headers = headers
         self.session = session
-        self.user = session.user
         self.task_manager = task_manager
+        # looked up and wrapped on first access, most handlers read only some of them.
+        self._page = None
+        self._args = args
+        self._events = events
+
+    @property
+    def page(self) -> AsyncPage:
+        if self._page is None:
+            self._page = self.session.page(self.route, self.mode, self.user_info.user_id)
+        return self._page
+
+    @property
+    def args(self) -> Expando:
+        if not isinstance(self._args, Expando):
+            self._args = Expando(self._args)
+        return self._args
+
+    @property
+    def events(self) -> Expando:
+        if not isinstance(self._events, Expando):
+            self._events = Expando(self._events)
+        return self._events
+
+    @property
+    def user(self) -> Expando:
+        return self.session.user
 
     async def sleep(self, delay: float, result=None) -> Any:
         """
@@ -155,6 +1113,9 @@ class Query:
 
         To execute a function in-process, use `q.run()`.
 
+        Within a task with a deadline, see `run_in_back`, raises `DeadlineExceededError` if the deadline
+        passes first; a function running in an executor is not interrupted, its result is dropped.
+
         Args:
             executor: The executor to be used. If None, executes the function in-process.
             func: The function to to be called.
@@ -163,22 +1124,47 @@ class Query:
         Returns:
             The result of the function call.
         """
+        check_deadline()
         if asyncio.iscoroutinefunction(func):
-            return await func(*args, **kwargs)
+            return await _within_deadline(func(*args, **kwargs))
 
         loop = asyncio.get_event_loop()
 
         if contextvars is not None:  # Python 3.7+ only.
-            return await loop.run_in_executor(
+            # the function sees the deadline too, through the copied context.
+            return await _within_deadline(loop.run_in_executor(
                 executor,
                 contextvars.copy_context().run,
                 functools.partial(func, *args, **kwargs)
-            )
+            ))
 
         if kwargs:
-            return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+            return await _within_deadline(loop.run_in_executor(executor, functools.partial(func, *args, **kwargs)))
+
+        return await _within_deadline(loop.run_in_executor(executor, func, *args))
+
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds left until the deadline of the current handler or task, None if it has none.
+        Long-running handlers can check it between steps.
+        """
+        return remaining()
+
+    async def run_cpu(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Execute a CPU-bound function in the server's process pool, see `WaveApp.config_process_pool`.
+
+        Args:
+            func: The function to to be called, a picklable module-level function.
+            args: Arguments to be passed to the function.
+            kwargs: Keywords arguments to be passed to the function.
 
-        return await loop.run_in_executor(executor, func, *args)
+        Returns:
+            The result of the function call.
+        """
+        if ProcessPool.default is None:
+            ProcessPool.default = ProcessPool()
+        return await ProcessPool.default.run(func, *args, **kwargs)
 
     async def run(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
         """
@@ -196,5 +1182,90 @@ class Query:
         """
         return await self.exec(None, func, *args, **kwargs)
 
-    async def run_in_back(self, coro) -> Any:
-        return await self.task_manager.spawn(coro)
+    async def cached_run(self, key: Any, func: Callable, *args: Any, ttl: Optional[float] = None,
+                         executor: Optional[Executor] = None, **kwargs: Any) -> Any:
+        """
+        Like `q.exec(executor, func, *args, **kwargs)`, but the result is shared by all sessions through the
+        server-wide `ResultCache`, see `WaveApp.config_cache`. Calls with the same `key` while it is being
+        computed wait for that computation instead of starting another.
+
+        Args:
+            key: A hashable key of the result, e.g. `('report', day)`.
+            func: The function to to be called.
+            args: Arguments to be passed to the function.
+            ttl: Seconds to keep the result, the cache's default if not provided.
+            executor: The executor to be used. If None, executes the function in-process.
+            kwargs: Keywords arguments to be passed to the function.
+
+        Returns:
+            The result of the function call.
+        """
+        cache = default_cache()
+        compute = functools.partial(self.exec, executor, func, *args, **kwargs)
+        if ttl is None:
+            return await cache.get_or_run(key, compute)
+        return await cache.get_or_run(key, compute, ttl)
+
+    def every(self, interval: float, callback: Callable, jitter: float = 0.0) -> Timer:
+        """
+        Call `callback(q)` every `interval` seconds, e.g. to update a live page, returns its `Timer` to cancel it.
+        The callbacks of all sessions are started from the server's `TimerWheel`, batched per tick, see
+        `WaveApp.config_timers`. Runs are skipped while nobody watches the page, and the timer is cancelled
+        when the session goes away.
+
+        Every run is a background task of the session's currently connected client, like `q.run_in_back`:
+        it gets a `q` with that client's task pool, waits for the scheduler, counts against the task quota,
+        inherits no deadline and is cancelled when that client disconnects. A run is skipped while the previous
+        one is still going, or when the task is rejected.
+
+        Args:
+            interval: Seconds between runs.
+            callback: A function or coroutine function taking `q`.
+            jitter: Up to this many seconds are added to every run at random, to spread the runs of many sessions.
+        """
+        if TimerWheel.default is None:
+            TimerWheel.default = TimerWheel()
+        page = self.page
+        return TimerWheel.default.schedule(interval, functools.partial(self._every_run, callback), jitter,
+                                           active=lambda: page.watched, group=self.session.timers)
+
+    async def _every_run(self, callback: Callable):
+        task_manager = self.session.task_manager
+        if task_manager is None:
+            return
+        q = Query(self.user_info, self.session, self.route, self.url, self.headers, None, None, task_manager,
+                  self.mode)
+        try:
+            handle = await q.run_in_back(_call_async(callback, q))
+        except (QuotaExceededError, TaskRejectedError) as ex:
+            logger.info(f'timer run of {self.route} skipped: {ex}')
+            return
+        await handle
+
+    async def run_in_back(self, coro, priority='background', timeout: Optional[float] = None) -> Any:
+        """
+        Run a coroutine in the background, returns its `TaskHandle` to await or cancel it.
+        `priority='interactive'` gets a slot of the server-wide scheduler before background tasks.
+        With `timeout`, the task is cancelled if it has not finished `timeout` seconds from now, and its
+        handle raises `DeadlineExceededError`; the task never outlives the deadline of its caller.
+        Tasks are cancelled when the client disconnects, `handle.reason` tells why a task was cancelled.
+        Raises `QuotaExceededError` if the session runs too many tasks already, `TaskRejectedError` if the
+        client's task pool and its queue are full, or the client disconnected.
+        """
+        if not iscoroutine_or_partial(coro):
+            raise Exception('Only coroutine supported.')
+        usage = self.session.usage
+        try:
+            usage.start_task()
+        except QuotaExceededError:
+            close_coroutine(coro)
+            raise
+        try:
+            handle = await self.task_manager.spawn(coro, priority=priority, timeout=timeout)
+        except BaseException:
+            usage.task_done()
+            close_coroutine(coro)
+            raise
+        # counted until the task finishes or is cancelled, even before it starts.
+        handle.future.add_done_callback(usage.task_done)
+        return handle
@@ -0,0 +1,369 @@
+"""
+Server side model of a page.
+
+`PageState` applies page ops the same way the wave browser client does: whole-card puts and deletes,
+Ref paths (`card a b` sets `a.b` of the card, `card name attr` sets `attr` of the component named `name`),
+data buffers (`~field` entries pointing into the card's `b` list) and `__append__`. The cards it holds
+are exactly what the client needs in a `{"p": {"c": cards}}` snapshot.
+
+Cards can be compacted to their encoded bytes, optionally compressed, see `PageState.compact()`.
+A compacted card is inflated again when an op changes part of it.
+"""
+import re
+import zlib
+from typing import Any, Optional
+from . import codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_int_re = re.compile(r'^-?\d+$')
+_buffer_types = ('c', 'f', 'm', 'l')
+_named_fields = ('items', 'secondary_items', 'buttons')
+_panel_fields = ('side_panel', 'dialog', 'notification_bar')
+
+
+def _zstd_packer():
+    if zstandard is None:
+        raise ValueError('zstd compaction needs the zstandard package.')
+    compressor, decompressor = zstandard.ZstdCompressor(), zstandard.ZstdDecompressor()
+    return compressor.compress, decompressor.decompress
+
+
+_packers = {
+    'raw': lambda: (bytes, bytes),
+    'zlib': lambda: (lambda b: zlib.compress(b, 1), zlib.decompress),
+    'zstd': _zstd_packer,
+}
+
+
+def packer(name: str):
+    """
+    The `(pack, unpack)` functions of a compaction method: 'raw' keeps the encoded card, 'zlib' and 'zstd' compress it.
+    """
+    if name not in _packers:
+        raise ValueError(f'Unknown compaction {name}.')
+    return _packers[name]()
+
+
+def _parse_int(key) -> Optional[int]:
+    return int(key) if _int_re.match(key) else None
+
+
+def _buffer_spec(value) -> Optional[dict]:
+    if isinstance(value, dict) and len(value) == 1:
+        t = next(iter(value))
+        if t in _buffer_types and isinstance(value[t], dict):
+            return value
+    return None
+
+
+class _Row:
+    """
+    A row of a data buffer, addressed by field name or column index.
+    """
+    __slots__ = ('fields', 'row')
+
+    def __init__(self, fields, row):
+        self.fields = fields
+        self.row = row
+
+    def _index(self, key) -> Optional[int]:
+        if key in self.fields:
+            return self.fields.index(key)
+        i = _parse_int(key)
+        return i if i is not None and 0 <= i < len(self.row) else None
+
+    def get(self, key):
+        i = self._index(key)
+        return None if i is None else self.row[i]
+
+    def set(self, key, value):
+        i = self._index(key)
+        if i is not None:
+            self.row[i] = value
+
+
+class _Buffer:
+    """
+    A data buffer, operating in place on its serialized form: {'c'|'f'|'m'|'l': {'f': fields, 'd': rows, ...}}.
+    """
+    __slots__ = ('t', 'b')
+
+    def __init__(self, spec: dict):
+        self.t, self.b = next(iter(spec.items()))
+        b = self.b
+        if self.t == 'm':
+            if not isinstance(b.get('d'), dict):
+                b['d'] = {}
+        elif self.t == 'l':
+            if not b.get('d'):
+                b['d'] = []
+        elif not b.get('d'):
+            n = b.get('n') or 0
+            b['d'] = [None] * (n if n > 0 else 10)
+            if self.t == 'c':
+                b['i'] = 0
+        if self.t == 'c' and b.get('i') is None:
+            b['i'] = len(b['d'])
+
+    def _match(self, row) -> bool:
+        return isinstance(row, list) and len(row) == len(self.b['f'])
+
+    def _seti(self, i, row):
+        rows = self.b['d']
+        if 0 <= i < len(rows):
+            if row is None:
+                rows[i] = None
+            elif self._match(row):
+                rows[i] = row
+
+    def get(self, key) -> Optional[_Row]:
+        rows = self.b['d']
+        if self.t == 'm':
+            row = rows.get(key)
+        else:
+            i = self.b['i'] if self.t == 'c' else _parse_int(key)
+            row = rows[i] if i is not None and 0 <= i < len(rows) else None
+        return _Row(self.b['f'], row) if row else None
+
+    def set(self, key, row):
+        b = self.b
+        rows = b['d']
+        if self.t == 'm':
+            if row is None:
+                rows.pop(key, None)
+            elif self._match(row):
+                rows[key] = row
+        elif self.t == 'f':
+            i = _parse_int(key)
+            if i is not None:
+                self._seti(i, row)
+        elif self.t == 'c':
+            self._seti(b['i'], row)
+            b['i'] = b['i'] + 1 if b['i'] + 1 < len(rows) else 0
+        else:
+            i = _parse_int(key) if key != '' else None
+            if i is not None:
+                if i < 0:
+                    i += len(rows)
+                if 0 <= i < len(rows):
+                    self._seti(i, row)
+                    return
+            if self._match(row):
+                rows.append(row)
+
+    def put(self, value):
+        if self.t == 'm':
+            if isinstance(value, dict):
+                self.b['d'] = {k: v for k, v in value.items() if self._match(v)}
+        elif isinstance(value, list):
+            if self.t == 'f':
+                if len(value) == len(self.b['d']):
+                    for i, row in enumerate(value):
+                        self._seti(i, row)
+            else:
+                for row in value:
+                    self.set('', row)
+
+
+def _get(obj, key):
+    if isinstance(obj, (_Buffer, _Row)):
+        return obj.get(key)
+    if isinstance(obj, dict):
+        return obj.get(key)
+    if isinstance(obj, list):
+        i = _parse_int(key)
+        if i is not None and 0 <= i < len(obj):
+            return obj[i]
+    return None
+
+
+def _set(obj, key, value):
+    if isinstance(obj, (_Buffer, _Row)):
+        obj.set(key, value)
+    elif isinstance(obj, dict):
+        if value is None:
+            obj.pop(key, None)
+        else:
+            obj[key] = value
+    elif isinstance(obj, list):
+        i = _parse_int(key)
+        if i is not None and 0 <= i < len(obj):
+            obj[i] = value
+
+
+def _index_names(names: dict, items):
+    if not isinstance(items, list):
+        return
+    for item in items:
+        component = item
+        if isinstance(item, dict) and item:
+            first = next(iter(item.values()))
+            if isinstance(first, dict):
+                component = first
+        if isinstance(component, dict):
+            if component.get('name'):
+                names[component['name']] = component
+            for field in _named_fields:
+                _index_names(names, component.get(field))
+
+
+class PageState:
+    """
+    The cards of a page, updated in place by `apply()`.
+
+    Cards put by an op share their dicts with the op until a Ref op changes them, the card is copied then.
+    Compacted cards are kept in `packed` instead of `cards`.
+    """
+
+    def __init__(self):
+        self.cards = {}
+        self.packed = {}
+        self._unpack = None
+        self._shared = set()
+        self._names = {}
+
+    def compact(self, pack, unpack):
+        """
+        Replace every card by its packed bytes.
+        """
+        for card_key, card in self.cards.items():
+            self.packed[card_key] = pack(codec.dumpb(card))
+        self._unpack = unpack
+        self.cards = {}
+        self._shared.clear()
+        self._names.clear()
+
+    def _inflate(self, card_key):
+        data = self.packed.pop(card_key, None)
+        if data is not None:
+            self.cards[card_key] = codec.loads(self._unpack(data))
+
+    def inflate(self):
+        for card_key in list(self.packed):
+            self._inflate(card_key)
+
+    def all_cards(self) -> dict:
+        """
+        All cards, compacted ones decoded without inflating them.
+        """
+        if not self.packed:
+            return self.cards
+        cards = {k: codec.loads(self._unpack(data)) for k, data in self.packed.items()}
+        cards.update(self.cards)
+        return cards
+
+    def packed_size(self) -> int:
+        return sum(len(data) for data in self.packed.values())
+
+    def apply(self, ops: list):
+        for op in ops:
+            self.apply_op(op)
+
+    def apply_op(self, op: dict):
+        key = op.get('k')
+        if not key:
+            self.cards = {}
+            self.packed.clear()
+            self._shared.clear()
+            self._names.clear()
+            return
+        path = key.split()
+        card_key = path[0]
+        if len(path) == 1:
+            self._forget(card_key)
+            self.packed.pop(card_key, None)
+            if 'd' in op:
+                card = {'d': op['d']}
+                if op.get('b'):
+                    card['b'] = op['b']
+                self.cards[card_key] = card
+                self._shared.add(card_key)
+            else:
+                self.cards.pop(card_key, None)
+            return
+        if card_key in self.packed:
+            self._inflate(card_key)
+        card = self._own(card_key)
+        if card is None:
+            return
+        value = None
+        for t in _buffer_types:
+            if t in op:
+                value = {t: op[t]}
+                break
+        else:
+            value = op.get('v')
+        if isinstance(value, (dict, list)):
+            # never share containers with the op, the state changes them in place.
+            value = codec.loads(codec.dumpb(value))
+        self._set(card_key, card, path[1:], value)
+
+    def _forget(self, card_key):
+        self._shared.discard(card_key)
+        self._names.pop(card_key, None)
+
+    def _own(self, card_key) -> Optional[dict]:
+        card = self.cards.get(card_key)
+        if card is not None and card_key in self._shared:
+            card = codec.loads(codec.dumpb(card))
+            self.cards[card_key] = card
+            self._forget(card_key)
+        return card
+
+    def _card_names(self, card_key, card) -> dict:
+        names = self._names.get(card_key)
+        if names is None:
+            names = {}
+            d = card['d']
+            for field in _named_fields:
+                _index_names(names, d.get(field))
+            for field in _panel_fields:
+                panel = d.get(field)
+                if isinstance(panel, dict):
+                    _index_names(names, panel.get('items') or panel.get('buttons'))
+            self._names[card_key] = names
+        return names
+
+    def _buffer(self, card, field) -> Optional[_Buffer]:
+        i = card['d'].get('~' + field)
+        bufs = card.get('b')
+        if isinstance(i, int) and bufs and 0 <= i < len(bufs) and _buffer_spec(bufs[i]):
+            return _Buffer(bufs[i])
+        return None
+
+    def _set(self, card_key, card, path, value: Any):
+        d = card['d']
+        field = path[0]
+        if len(path) == 1:
+            spec = _buffer_spec(value)
+            buf = self._buffer(card, field)
+            if buf is not None:
+                if spec:
+                    card['b'][d['~' + field]] = spec
+                else:
+                    buf.put(value)
+                return
+            if spec:
+                bufs = card.setdefault('b', [])
+                d.pop(field, None)
+                d['~' + field] = len(bufs)
+                bufs.append(spec)
+            elif value is None:
+                d.pop(field, None)
+            else:
+                d[field] = value
+            if field in _named_fields or field in _panel_fields:
+                self._names.pop(card_key, None)
+            return
+        names = self._card_names(card_key, card)
+        if len(path) == 2 and field in names:
+            target = names[field]
+        else:
+            target = self._buffer(card, field) or d.get(field)
+            for k in path[1:-1]:
+                target = _get(target, k)
+        _set(target, path[-1], value)
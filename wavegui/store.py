@@ -0,0 +1,234 @@
+"""
+Session storage backends.
+
+A store keeps one record per session: the `q.user` data encoded with the codec, a little metadata and the snapshot
+of every page, `{"p": {"c": cards}, "s": seq, "e": epoch}` as the client receives it, compressed with zlib.
+The `SessionRegistry` is the in-process cache in front of the store: it loads a session on first use,
+restores its pages when they are first used, writes changed sessions back in batches and writes
+everything left when the server shuts down. Pages shared by multicast and broadcast apps are stored
+as one more record, `SHARED`.
+
+A save replaces the whole record of a session and registries do not see the writes of each other, so a session
+must only be served by one process at a time: several processes can share a store when every session sticks to
+one of them, as with the session-affine dispatcher of `run_workers`, not behind a load balancer that spreads
+the requests of a session.
+
+    from wavegui import WaveApp
+    from wavegui.store import SQLiteStore
+    WaveApp.config_session_store(store=SQLiteStore('sessions.db'), flush_interval=1)
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+SHARED = '~shared'
+
+
+def pack_snapshot(payload: bytes, level=1) -> bytes:
+    return zlib.compress(payload, level)
+
+
+def unpack_snapshot(data: bytes) -> bytes:
+    # snapshots are JSON objects, anything else is compressed.
+    return data if data[:1] == b'{' else zlib.decompress(data)
+
+
+class SessionRecord:
+    """
+    The stored form of a session.
+
+    Args:
+        user: The `q.user` data encoded with the codec, None if it could not be encoded.
+        pages: Packed page snapshots by route, see `pack_snapshot`.
+        meta: Session metadata, e.g. its start time.
+        updated: Time of the write, seconds since the epoch.
+    """
+    __slots__ = ('user', 'pages', 'meta', 'updated')
+
+    def __init__(self, user: Optional[bytes], pages: Dict[str, bytes], meta: dict = None, updated: float = None):
+        self.user = user
+        self.pages = pages
+        self.meta = meta or {}
+        self.updated = updated or time.time()
+
+
+class SessionStore:
+    """
+    Interface of a session store. Methods are called from a worker thread and may block.
+    """
+
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        raise NotImplementedError()
+
+    def save(self, records: Dict[str, SessionRecord]):
+        """
+        Write a batch of records, replacing the stored ones.
+        """
+        raise NotImplementedError()
+
+    def delete(self, session_id: str):
+        raise NotImplementedError()
+
+    def expire(self, max_age: float) -> int:
+        """
+        Delete the records not written for `max_age` seconds, returns how many.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemoryStore(SessionStore):
+    """
+    Keeps the records in a dict, they are lost with the process.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def load(self, session_id):
+        with self._lock:
+            return self._records.get(session_id)
+
+    def save(self, records):
+        with self._lock:
+            self._records.update(records)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._records.pop(session_id, None)
+
+    def expire(self, max_age):
+        deadline = time.time() - max_age
+        with self._lock:
+            expired = [k for k, r in self._records.items() if r.updated < deadline]
+            for k in expired:
+                del self._records[k]
+        return len(expired)
+
+
+class SQLiteStore(SessionStore):
+    """
+    Keeps the records in an SQLite database in WAL mode, so readers do not wait for the batched writes:
+    `load` reads through a connection of its own, it never waits for a `save` holding the write connection.
+
+    The connections are opened on first use, by every process using the store: SQLite connections must not
+    be used across a fork, e.g. by the workers of `run_workers` when the store is configured before they start.
+
+    Args:
+        path: The database file.
+        synchronous: The SQLite `synchronous` pragma, `NORMAL` is safe with WAL and only loses the last writes on power loss.
+    """
+
+    def __init__(self, path: str, synchronous: str = 'NORMAL'):
+        self.path = path
+        self.synchronous = synchronous
+        # (lock, db, read lock, read db) by process id. The connections inherited from a parent are kept,
+        # never used nor closed.
+        self._connections = {}
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        pid = os.getpid()
+        connections = self._connections.get(pid)
+        if connections is not None:
+            return connections
+        with self._open_lock:
+            connections = self._connections.get(pid)
+            if connections is not None:
+                return connections
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(f'PRAGMA synchronous={self.synchronous}')
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, updated REAL, user BLOB, meta BLOB)')
+            db.execute('CREATE TABLE IF NOT EXISTS pages (session TEXT, route TEXT, snapshot BLOB, '
+                       'PRIMARY KEY (session, route))')
+            db.execute('CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)')
+            lock = threading.Lock()
+            if self.path == ':memory:':
+                # an in-memory database is private to its connection.
+                connections = (lock, db, lock, db)
+            else:
+                read_db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                connections = (lock, db, threading.Lock(), read_db)
+            self._connections[pid] = connections
+            return connections
+
+    def load(self, session_id):
+        _, _, read_lock, db = self._open()
+        with read_lock:
+            # one read transaction, so the session and its pages come from the same write.
+            db.execute('BEGIN')
+            try:
+                row = db.execute('SELECT user, meta, updated FROM sessions WHERE id = ?', (session_id,)).fetchone()
+                pages = [] if row is None else \
+                    db.execute('SELECT route, snapshot FROM pages WHERE session = ?', (session_id,)).fetchall()
+            finally:
+                db.execute('COMMIT')
+        if row is None:
+            return None
+        return SessionRecord(row[0], dict(pages), codec.loads(row[1]) if row[1] else None, row[2])
+
+    def save(self, records):
+        if not records:
+            return
+        lock, db, _, _ = self._open()
+        with lock:
+            db.execute('BEGIN')
+            try:
+                for session_id, record in records.items():
+                    db.execute('INSERT OR REPLACE INTO sessions (id, updated, user, meta) VALUES (?, ?, ?, ?)',
+                               (session_id, record.updated, record.user, codec.dumpb(record.meta)))
+                    db.execute('DELETE FROM pages WHERE session = ?', (session_id,))
+                    db.executemany('INSERT INTO pages (session, route, snapshot) VALUES (?, ?, ?)',
+                                   [(session_id, route, snapshot) for route, snapshot in record.pages.items()])
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def delete(self, session_id):
+        lock, db, _, _ = self._open()
+        with lock:
+            db.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+            db.execute('DELETE FROM pages WHERE session = ?', (session_id,))
+
+    def expire(self, max_age):
+        deadline = time.time() - max_age
+        lock, db, _, _ = self._open()
+        with lock:
+            db.execute('BEGIN')
+            try:
+                db.execute('DELETE FROM pages WHERE session IN (SELECT id FROM sessions WHERE updated < ?)', (deadline,))
+                n = db.execute('DELETE FROM sessions WHERE updated < ?', (deadline,)).rowcount
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return n
+
+    def close(self):
+        """
+        Close the connections of this process, the store opens new ones when used again.
+        """
+        connections = self._connections.pop(os.getpid(), None)
+        if connections is None:
+            return
+        lock, db, read_lock, read_db = connections
+        if read_db is not db:
+            with read_lock:
+                read_db.close()
+        with lock:
+            db.close()
@@ -1,22 +1,293 @@
 
 import asyncio
-from asyncio import Semaphore
 from asyncio import CancelledError
-import asyncio
+import contextvars
 from functools import partial
 import inspect
 import logging
+import time
+import importlib
+import math
+import os
+import pickle
+import random
+import sys
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from .exception import TaskRejectedError, DeadlineExceededError
 
 logger = logging.getLogger(__name__)
 
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+CALLER_RUNS = 'caller_runs'
+_overflow_policies = (REJECT, DROP_OLDEST, CALLER_RUNS)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+_priorities = (INTERACTIVE, BACKGROUND)
+
+# reasons recorded on cancelled and timed out tasks.
+CANCELLED = 'cancelled'
+DROPPED = 'dropped'
+TIMEOUT = 'timeout'
+DEADLINE = 'deadline'
+DISCONNECT = 'disconnect'
+SHUTDOWN = 'shutdown'
+
+# the `time.monotonic()` by which the current task must finish, None for no deadline.
+_deadline = contextvars.ContextVar('wavegui_deadline', default=None)
+
+
+def deadline():
+    """
+    The `time.monotonic()` by which the current task must finish, None if it has no deadline.
+    """
+    return _deadline.get()
+
+
+def remaining():
+    """
+    Seconds left until the deadline of the current task, None if it has no deadline.
+    """
+    d = _deadline.get()
+    return None if d is None else max(0.0, d - time.monotonic())
+
+
+def check_deadline():
+    """
+    Raise `DeadlineExceededError` if the deadline of the current task has passed.
+    """
+    d = _deadline.get()
+    if d is not None and time.monotonic() >= d:
+        raise DeadlineExceededError('deadline exceeded.')
+
+
+def set_deadline(timeout):
+    """
+    Give the current context a deadline `timeout` seconds from now, or keep its earlier one.
+    Returns the token to restore the previous deadline with `reset_deadline`.
+    """
+    return _deadline.set(_child_deadline(timeout))
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def _child_deadline(timeout):
+    # a task never outlives the deadline of the task that spawned it.
+    parent = _deadline.get()
+    if timeout is None:
+        return parent
+    d = time.monotonic() + timeout
+    return d if parent is None else min(parent, d)
+
+
+def close_coroutine(coro):
+    """
+    Close `coro` if it is a coroutine that will never run, else it warns that it was never awaited when collected.
+    """
+    if inspect.iscoroutine(coro):
+        coro.close()
+
+
+class TaskHandle(object):
+    """
+    A task accepted by an `AsyncPool`. Await it for the result of the task, or cancel it,
+    whether it is still pending or already running.
+
+    `deadline` is the `time.monotonic()` by which the task must finish, None for the pool's
+    `max_running_time`. `reason` records why the task was cancelled or timed out, see `cancel`.
+    """
+    __slots__ = ('coro', 'future', 'task', 'pool', 'priority', 'queued_at', 'deadline', 'reason')
+
+    def __init__(self, coro, pool=None, priority=BACKGROUND, deadline=None):
+        self.coro = coro
+        self.future = asyncio.get_event_loop().create_future()
+        self.task = None
+        self.pool = pool
+        self.priority = priority
+        self.queued_at = None
+        self.deadline = deadline
+        self.reason = None
+
+    @property
+    def pending(self):
+        return self.task is None and not self.future.done()
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self, reason=CANCELLED):
+        """
+        Cancel the task, recording `reason`, e.g. `disconnect` when its client went away.
+        """
+        if self.future.done():
+            return
+        if self.reason is None:
+            self.reason = reason
+        if self.task is not None:
+            self.task.cancel()
+        else:
+            close_coroutine(self.coro)
+            self.future.cancel()
+            if self.pool is not None:
+                self.pool._cancelled(self)
+
+    def result(self):
+        return self.future.result()
+
+    def _set(self, result=None, exception=None):
+        if self.future.done():
+            return
+        if exception is not None:
+            self.future.set_exception(exception)
+            # the task already logged it, nobody has to retrieve it.
+            self.future.exception()
+        else:
+            self.future.set_result(result)
+
+    def __await__(self):
+        return asyncio.shield(self.future).__await__()
+
+
+class _Tenant(object):
+    __slots__ = ('name', 'weight', 'queues', 'credit')
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.queues = {p: deque() for p in _priorities}
+        self.credit = weight
+
+
+class Scheduler(object):
+    """
+    Shares a process-wide limit of running tasks between all `TaskManager`s.
+
+    Tasks that find no free slot wait in a queue of their tenant, the name of their `TaskManager`
+    (the session id for client tasks). Freed slots go to `interactive` tasks first, then `background` ones,
+    and within a class round robin across tenants: a tenant starts up to its weight of tasks in a row.
+
+    Args:
+        max_running: Maximum number of tasks running at once in the process, None for no limit.
+        weights: Weight of tenants by name, 1 for the others.
+    """
+    def __init__(self, max_running=None, weights=None):
+        self.max_running = max_running
+        self.weights = dict(weights or {})
+        self.running = 0
+        self._queued = 0
+        self._tenants = {}
+        self._rings = {p: OrderedDict() for p in _priorities}
+        self.stats = {p: dict(started=0, queued=0, wait_total=0.0, wait_max=0.0) for p in _priorities}
+
+    def configure(self, max_running=None, weights=None):
+        self.max_running = max_running
+        if weights:
+            self.weights.update(weights)
+        self._start_waiting()
+
+    def queued(self) -> int:
+        return self._queued
+
+    def report(self) -> dict:
+        """
+        Running and queued tasks, and how long tasks waited for a slot per priority class, in seconds.
+        """
+        waits = {}
+        for p, st in self.stats.items():
+            waits[p] = dict(st, wait_mean=st['wait_total'] / st['started'] if st['started'] else 0.0)
+        return dict(running=self.running, queued=self.queued(), classes=waits)
+
+    def _full(self):
+        return self.max_running is not None and self.running >= self.max_running
+
+    def submit(self, handle: TaskHandle, tenant_name: str):
+        """
+        Start `handle` now if a slot is free, else queue it.
+        """
+        if not self._full() and self._queued == 0:
+            self._launch(handle, 0.0)
+            return
+        tenant = self._tenants.get(tenant_name)
+        if tenant is None:
+            tenant = self._tenants[tenant_name] = _Tenant(tenant_name, self.weights.get(tenant_name, 1))
+        handle.queued_at = time.monotonic()
+        tenant.queues[handle.priority].append(handle)
+        self._queued += 1
+        self._rings[handle.priority].setdefault(tenant_name, tenant)
+        self.stats[handle.priority]['queued'] += 1
+        self._start_waiting()
+
+    def _launch(self, handle, wait):
+        st = self.stats[handle.priority]
+        st['started'] += 1
+        st['wait_total'] += wait
+        st['wait_max'] = max(st['wait_max'], wait)
+        self.running += 1
+        handle.pool._launch(handle)
+
+    def _next(self) -> TaskHandle:
+        for priority in _priorities:
+            ring = self._rings[priority]
+            while ring:
+                name, tenant = next(iter(ring.items()))
+                queue = tenant.queues[priority]
+                handle = queue.popleft() if queue else None
+                self._queued -= handle is not None
+                tenant.credit -= 1
+                if not queue:
+                    del ring[name]
+                    tenant.credit = tenant.weight
+                    if not any(tenant.queues.values()):
+                        del self._tenants[name]
+                elif tenant.credit <= 0:
+                    ring.move_to_end(name)
+                    tenant.credit = tenant.weight
+                if handle is not None and not handle.future.done():
+                    return handle
+        return None
+
+    def _start_waiting(self):
+        while not self._full():
+            handle = self._next()
+            if handle is None:
+                return
+            self._launch(handle, time.monotonic() - handle.queued_at)
+
+    def release(self):
+        self.running -= 1
+        self._start_waiting()
+
+
 class AsyncPool(object):
-    def __init__(self, size=10, max_running_time=300):
+    """
+    Runs at most `size` tasks at once. `spawn` never waits for a free slot: tasks beyond `size`
+    wait in a queue of up to `max_pending` tasks, and when that queue is full `overflow` decides:
+    `reject` raises `TaskRejectedError`, `drop_oldest` cancels the oldest waiting task,
+    `caller_runs` runs the task in the caller, which then waits for it.
+
+    A task runs for at most `max_running_time` seconds, or until its own deadline when it has one,
+    see `spawn`. `reasons` counts cancelled and timed out tasks by reason.
+    A pool closed with `close` cancels its tasks and rejects new ones, `closed` is the reason.
+    """
+    def __init__(self, size=10, max_running_time=300, max_pending=100, overflow=REJECT, scheduler=None, name=''):
+        if overflow not in _overflow_policies:
+            raise ValueError(f'Unknown overflow policy {overflow}.')
+        self.scheduler = scheduler
+        self.name = name
         self.size = size
         self.max_running_time = max_running_time
-        self.waiting = set()
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.waiting = deque()
         self.active = set()
-        self.semaphore = Semaphore(self.size)
-
+        self.stats = dict(spawned=0, completed=0, failed=0, timeout=0, cancelled=0,
+            rejected=0, dropped=0, caller_runs=0, deadline=0)
+        self.reasons = {}
+        self.closed = None
 
     @property
     def is_empty(self):
@@ -24,42 +295,179 @@ class AsyncPool(object):
 
     @property
     def is_full(self):
-        return self.size <= len(self.waiting) + len(self.active)
+        return self.size + self.max_pending <= len(self.waiting) + len(self.active)
 
-    async def coro_wrap(self, coro, cb=None, ctx=None):
-        parent_task = asyncio.current_task()
-        task = asyncio.create_task(coro)
-        self.waiting.remove(parent_task)
-        self.active.add(parent_task)
+    def _count(self, handle, reason):
+        if handle.reason is None:
+            handle.reason = reason
+        self.reasons[handle.reason] = self.reasons.get(handle.reason, 0) + 1
+
+    async def _run(self, handle, caller=False):
+        timeout, reason = self.max_running_time, TIMEOUT
+        # the task and everything it awaits see its own deadline, e.g. nested `q.exec` calls, never the one of
+        # the task it was started from by a freed slot.
+        token = _deadline.set(handle.deadline)
+        if handle.deadline is not None:
+            left = handle.deadline - time.monotonic()
+            if timeout is None or left < timeout:
+                timeout, reason = max(0.0, left), DEADLINE
         try:
-            ret = await asyncio.wait_for(task, timeout=self.max_running_time)
-            logger.debug("task returned: {ret}.", ret=ret)
-        except asyncio.TimeoutError:
-            logger.error('timeout')
+            ret = await asyncio.wait_for(handle.coro, timeout=timeout)
+            logger.debug(f'task returned: {ret}.')
+            self.stats['completed'] += 1
+            handle._set(ret)
+        except asyncio.TimeoutError as ex:
+            if reason == DEADLINE or isinstance(ex, DeadlineExceededError):
+                logger.info('task deadline exceeded.')
+                self.stats['deadline'] += 1
+                self._count(handle, DEADLINE)
+                handle._set(exception=ex if isinstance(ex, DeadlineExceededError)
+                            else DeadlineExceededError('deadline exceeded.'))
+            else:
+                logger.error('timeout')
+                self.stats['timeout'] += 1
+                self._count(handle, TIMEOUT)
+                handle._set(exception=ex)
+        except CancelledError:
+            self.stats['cancelled'] += 1
+            self._count(handle, CANCELLED)
+            logger.debug(f'task cancelled: {handle.reason}.')
+            handle.future.cancel()
+            if caller:
+                raise
         except Exception as ex:
             logger.error(f'exception: {ex}')
+            self.stats['failed'] += 1
+            handle._set(exception=ex)
         finally:
-            logger.debug("task completed, will release semaphor.")
-            self.semaphore.release()
-            self.active.remove(parent_task)
+            _deadline.reset(token)
+            self.active.discard(handle)
+            if self.scheduler is not None and not caller:
+                self.scheduler.release()
+            self._start_waiting()
+
+    def _start(self, handle):
+        self.active.add(handle)
+        if self.scheduler is not None:
+            # holds the slot of the pool while it waits for one of the scheduler.
+            self.scheduler.submit(handle, self.name)
+        else:
+            self._launch(handle)
+
+    def _launch(self, handle):
+        handle.task = asyncio.create_task(self._run(handle))
+        handle.task.add_done_callback(partial(self._unstarted, handle))
+
+    def _unstarted(self, handle, task):
+        # a task cancelled before its first step never runs `_run`, nor its `finally`.
+        if handle not in self.active or handle.task is not task:
+            return
+        close_coroutine(handle.coro)
+        self.stats['cancelled'] += 1
+        self._count(handle, CANCELLED)
+        handle.future.cancel()
+        self.active.discard(handle)
+        if self.scheduler is not None:
+            self.scheduler.release()
+        self._start_waiting()
+
+    def _cancelled(self, handle):
+        self._count(handle, CANCELLED)
+        if handle in self.active:
+            self.active.discard(handle)
+            self._start_waiting()
+
+    def _start_waiting(self):
+        while self.waiting and len(self.active) < self.size:
+            handle = self.waiting.popleft()
+            if not handle.future.done():
+                self._start(handle)
+
+    async def spawn(self, coro, cb=None, ctx=None, priority=BACKGROUND, timeout=None) -> TaskHandle:
+        """
+        Accept `coro`, returns its handle. Only waits with the `caller_runs` policy when the pool is full.
+
+        With `timeout`, the task must finish within that many seconds of the call, its wait in the queue
+        included, else it is cancelled and its handle raises `DeadlineExceededError`. A task spawned by
+        a task with a deadline never gets a later one.
+        """
+        if priority not in _priorities:
+            raise ValueError(f'Unknown priority {priority}.')
+        if self.closed is not None:
+            self.stats['rejected'] += 1
+            close_coroutine(coro)
+            raise TaskRejectedError(f'pool closed: {self.closed}.')
+        handle = TaskHandle(coro, self, priority, _child_deadline(timeout))
+        self.stats['spawned'] += 1
+        if len(self.active) < self.size:
+            self._start(handle)
+            return handle
+        self.waiting = deque(h for h in self.waiting if not h.future.done())
+        if len(self.waiting) < self.max_pending:
+            self.waiting.append(handle)
+            return handle
+        if self.overflow == DROP_OLDEST:
+            self.stats['dropped'] += 1
+            self.waiting.popleft().cancel(DROPPED)
+            self.waiting.append(handle)
+            return handle
+        if self.overflow == CALLER_RUNS:
+            self.stats['caller_runs'] += 1
+            self.active.add(handle)
+            handle.task = asyncio.current_task()
+            try:
+                await self._run(handle, caller=True)
+            finally:
+                handle.task = None
+            return handle
+        self.stats['rejected'] += 1
+        close_coroutine(coro)
+        raise TaskRejectedError(f'pool full, {len(self.active)} running and {len(self.waiting)} waiting.')
+
+    def cancel_all(self, reason=CANCELLED):
+        """
+        Cancel the waiting and running tasks with `reason`, returns the asyncio tasks that were running.
+        """
+        for handle in self.waiting:
+            handle.cancel(reason)
+        self.waiting.clear()
+        tasks = []
+        current = asyncio.current_task()
+        for handle in list(self.active):
+            if handle.task is current:
+                # a `caller_runs` task of the caller itself.
+                continue
+            if handle.task is not None:
+                tasks.append(handle.task)
+            handle.cancel(reason)
+        return tasks
 
-    async def spawn(self, coro, cb=None, ctx=None):
-        await self.semaphore.acquire()
-        task = asyncio.create_task(self.coro_wrap(coro))
-        self.waiting.add(task)
+    def close(self, reason=SHUTDOWN):
+        """
+        Cancel the tasks with `reason` like `cancel_all`, and reject the tasks spawned from now on.
+        """
+        self.closed = reason
+        return self.cancel_all(reason)
 
     async def join(self, timeout=3):
-        tasks = self.active | self.waiting
+        for handle in self.waiting:
+            handle.cancel(SHUTDOWN)
+        self.waiting.clear()
+        tasks = [h.task for h in self.active if h.task is not None]
         if len(tasks) > 0:
             done, pending = await asyncio.wait(tasks, timeout=timeout)
             waiting = []
+            for handle in list(self.active):
+                if handle.task in pending and handle.reason is None:
+                    handle.reason = SHUTDOWN
             for task in pending:
                 try:
                     task.cancel()
                     waiting.append(task)
                 except CancelledError:
                     pass
-            await asyncio.wait(waiting, timeout=2)
+            if waiting:
+                await asyncio.wait(waiting, timeout=2)
 
 
 
@@ -70,6 +478,7 @@ def iscoroutine_or_partial(obj):
 
 class TaskManager(object):
     _managers = {}
+    scheduler = Scheduler()
 
     @classmethod
     def create(cls, name, **kwargs):
@@ -89,15 +498,287 @@ class TaskManager(object):
     def __init__(self, name, **kwargs):
         self.pool_size = kwargs.get('pool_size') or 10
         self.name = name
-        self.pool = AsyncPool(size=self.pool_size)
+        self.pool = AsyncPool(size=self.pool_size, max_pending=kwargs.get('max_pending', 100),
+            overflow=kwargs.get('overflow') or REJECT, scheduler=kwargs.get('scheduler', self.scheduler), name=name)
 
-    async def spawn(self, coro):
+    async def spawn(self, coro, priority=BACKGROUND, timeout=None) -> TaskHandle:
+        """
+        Run `coro` in the pool, see `AsyncPool.spawn`. `interactive` tasks get a slot of the scheduler
+        before `background` ones.
+        """
         if not iscoroutine_or_partial(coro):
             raise Exception('Only coroutine supported.')
+        return await self.pool.spawn(coro, priority=priority, timeout=timeout)
+
+    async def cancel(self, reason=CANCELLED, timeout=1):
+        """
+        Cancel all tasks with `reason` now, and wait up to `timeout` seconds for them to unwind.
+        """
+        tasks = self.pool.cancel_all(reason)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def close(self, reason=SHUTDOWN, timeout=1):
+        """
+        Cancel all tasks like `cancel`, and reject the tasks spawned from now on, e.g. by handlers
+        of a disconnected client still running.
+        """
+        tasks = self.pool.close(reason)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def join(self, timeout=3):
+        await self.pool.join(timeout)
+
+def _preload(modules):
+    for name in modules:
         try:
-            await self.pool.spawn(coro)
-        except CancelledError:
+            importlib.import_module(name)
+        except Exception:
+            logger.exception(f'failed to preload {name}.')
+
+
+def _warm(delay):
+    # keeps the worker busy long enough that the next warm call needs another one.
+    time.sleep(delay)
+    return os.getpid()
+
+
+def _call(payload, submitted):
+    started = time.time()
+    func, args, kwargs = pickle.loads(payload)
+    result = func(*args, **kwargs)
+    return pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), started - submitted, time.time() - started
+
+
+class ProcessPool(object):
+    """
+    A pool of worker processes for CPU-bound functions, managed by the server.
+
+    Args:
+        size: Number of worker processes, the number of CPUs if not provided.
+        preload: Modules imported by every worker when it starts, e.g. the app's heavy dependencies.
+        mp_context: The multiprocessing context of the workers, the platform default if not provided.
+
+    Arguments and results are pickled once with the highest protocol, so large buffers are copied
+    without being re-encoded. Every call records its queue time, from the submit to the start in a worker,
+    and its run time, in `stats` and in the `calls` of the last 100 calls.
+    """
+    default = None
+
+    def __init__(self, size=None, preload=(), mp_context=None):
+        self.size = size or os.cpu_count() or 1
+        self.preload = list(preload)
+        self.mp_context = mp_context
+        self.executor = None
+        self.calls = deque(maxlen=100)
+        self.stats = dict(calls=0, failed=0, queue_total=0.0, queue_max=0.0, run_total=0.0, run_max=0.0)
+
+    def _executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.size, mp_context=self.mp_context,
+                initializer=_preload, initargs=(self.preload,))
+        return self.executor
+
+    async def start(self, delay=0.05):
+        """
+        Start every worker now, so the first calls do not wait for processes to start and import the app.
+        """
+        loop = asyncio.get_event_loop()
+        executor = self._executor()
+        pids = await asyncio.gather(*[loop.run_in_executor(executor, _warm, delay) for _ in range(self.size)])
+        logger.info(f'{len(set(pids))} cpu workers started.')
+        return set(pids)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Call `func(*args, **kwargs)` in a worker process, `func` and its arguments must be picklable.
+        """
+        payload = pickle.dumps((func, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        loop = asyncio.get_event_loop()
+        try:
+            result, queued, ran = await loop.run_in_executor(self._executor(), _call, payload, time.time())
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        st = self.stats
+        st['calls'] += 1
+        st['queue_total'] += queued
+        st['queue_max'] = max(st['queue_max'], queued)
+        st['run_total'] += ran
+        st['run_max'] = max(st['run_max'], ran)
+        self.calls.append((getattr(func, '__qualname__', repr(func)), queued, ran))
+        logger.debug(f'cpu call {self.calls[-1][0]} queued {queued:.4f}s, ran {ran:.4f}s.')
+        return pickle.loads(result)
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            if sys.version_info >= (3, 9):
+                self.executor.shutdown(wait=wait, cancel_futures=True)
+            else:  # pragma: no cover
+                self.executor.shutdown(wait=wait)
+            self.executor = None
+
+
+class Timer(object):
+    """
+    A periodic callback of a `TimerWheel`, see `TimerWheel.schedule`.
+    """
+    __slots__ = ('wheel', 'interval', 'callback', 'jitter', 'active', 'group', 'target', 'cancelled', 'running',
+                 'runs', 'skipped')
+
+    def __init__(self, wheel, interval, callback, jitter=0.0, active=None, group=None):
+        self.wheel = wheel
+        self.interval = interval
+        self.callback = callback
+        self.jitter = jitter
+        self.active = active
+        self.group = group
+        self.target = 0
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+
+    def cancel(self):
+        if self.cancelled:
             return
+        self.cancelled = True
+        self.wheel.timers -= 1
+        if self.group is not None:
+            self.group.discard(self)
 
-    async def join(self, timeout=3):
-        await self.pool.join(timeout)
\ No newline at end of file
+
+class TimerWheel(object):
+    """
+    Runs the periodic callbacks of all sessions from one task, so thousands of `q.every` timers cost one wakeup
+    per tick instead of one each.
+
+    Timers are hashed into `slots` buckets by the tick they are due on. Every `tick` seconds the wheel takes the
+    timers due from the current bucket and runs them as one batch: plain callbacks in place, the coroutines they
+    return as tasks started together. A timer whose previous run has not finished, or whose `active` check fails, e.g. its page
+    is not watched, skips the run. The task stops while no timers are scheduled.
+
+    Args:
+        tick: Resolution of the timers in seconds, timers due within the same tick fire together.
+        slots: Number of buckets, timers further than `slots` ticks ahead stay in their bucket for more turns.
+    """
+    default = None
+
+    def __init__(self, tick=0.1, slots=512):
+        if tick <= 0 or slots <= 0:
+            raise ValueError('tick and slots must be positive.')
+        self.tick = tick
+        self.slots = slots
+        self.timers = 0
+        self.stats = dict(ticks=0, batches=0, fired=0, skipped=0, failed=0, late_max=0.0)
+        self._buckets = [[] for _ in range(slots)]
+        self._start = None
+        self._now = 0
+        self._task = None
+        # the runs in progress, by their task.
+        self._firing = {}
+
+    def _ticks(self):
+        return int((time.monotonic() - self._start) / self.tick)
+
+    def schedule(self, interval, callback, jitter=0.0, active=None, group=None) -> Timer:
+        """
+        Call `callback()` every `interval` seconds, returns its `Timer` to cancel it.
+
+        Args:
+            interval: Seconds between runs, rounded up to whole ticks.
+            callback: A function, may return an awaitable.
+            jitter: Up to this many seconds are added to every run at random, so timers started at once spread out.
+            active: Called before every run, the run is skipped if it returns False.
+            group: A set the timer is added to, and removed from when cancelled.
+        """
+        if interval <= 0:
+            raise ValueError('interval must be positive.')
+        timer = Timer(self, interval, callback, jitter, active, group)
+        if group is not None:
+            group.add(timer)
+        if self._task is None:
+            self._start = time.monotonic()
+            self._now = 0
+            # runs in a context of its own, the runs never see the deadline of the handler that started the wheel.
+            self._task = contextvars.Context().run(asyncio.ensure_future, self._run())
+        self.timers += 1
+        self._add(timer)
+        return timer
+
+    def _add(self, timer):
+        delay = timer.interval + (random.uniform(0, timer.jitter) if timer.jitter else 0)
+        timer.target = self._ticks() + max(1, math.ceil(delay / self.tick))
+        self._buckets[timer.target % self.slots].append(timer)
+
+    async def _run(self):
+        try:
+            while self.timers > 0:
+                due = self._start + (self._now + 1) * self.tick
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.stats['late_max'] = max(self.stats['late_max'], time.monotonic() - due)
+                current = self._ticks()
+                batch = []
+                # catches up on the ticks missed while the loop was busy.
+                while self._now < current:
+                    self._now += 1
+                    self.stats['ticks'] += 1
+                    i = self._now % self.slots
+                    bucket = self._buckets[i]
+                    if not bucket:
+                        continue
+                    later = []
+                    for timer in bucket:
+                        if timer.cancelled:
+                            continue
+                        (batch if timer.target <= self._now else later).append(timer)
+                    self._buckets[i] = later
+                if batch:
+                    self._fire(batch)
+        finally:
+            self._task = None
+            self._buckets = [[] for _ in range(self.slots)]
+
+    def _fire(self, batch):
+        self.stats['batches'] += 1
+        for timer in batch:
+            # rescheduled before the run, a slow callback does not delay its next one.
+            self._add(timer)
+            if timer.running or (timer.active is not None and not timer.active()):
+                timer.skipped += 1
+                self.stats['skipped'] += 1
+                continue
+            timer.runs += 1
+            self.stats['fired'] += 1
+            try:
+                ret = timer.callback()
+            except Exception:
+                logger.exception('timer callback failed.')
+                self.stats['failed'] += 1
+                continue
+            if inspect.isawaitable(ret):
+                timer.running = True
+                task = asyncio.ensure_future(ret)
+                self._firing[task] = timer
+                task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._firing.pop(task).running = False
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'timer callback failed: {task.exception()!r}.')
+            self.stats['failed'] += 1
+
+    def stop(self):
+        """
+        Cancel all timers and the runs in progress.
+        """
+        for bucket in self._buckets:
+            for timer in bucket:
+                timer.cancel()
+        for task in list(self._firing):
+            task.cancel()
+        if self._task is not None:
+            self._task.cancel()